@@ -0,0 +1,156 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tp-api"))
+
+try:
+    from app import db
+except ImportError:  # psycopg2 not installed
+    db = None
+
+
+class FakeInfo:
+    def __init__(self):
+        self.transaction_status = db.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.info = FakeInfo()
+
+    def close(self):
+        self.closed = 1
+
+
+@unittest.skipIf(db is None, "needs psycopg2")
+class BoundedConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(db.psycopg2, "connect", lambda **kwargs: FakeConnection())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pool(self, maxconn, timeout):
+        return db.BoundedConnectionPool(
+            minconn=0, maxconn=maxconn, timeout=timeout, max_lifetime=3600, max_idle=600, check_after=30,
+        )
+
+    def assert_quiescent(self, pool):
+        stats = pool.stats()
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["waiters"], 0)
+        self.assertEqual(stats["idle"], stats["size"])
+        self.assertLessEqual(stats["size"], pool.maxconn)
+
+    def test_churn_has_no_double_checkout_or_timeouts(self):
+        pool = self.pool(maxconn=3, timeout=0.5)
+        lock = threading.Lock()
+        checked_out = set()
+        errors = []
+
+        def worker():
+            for _ in range(30):
+                try:
+                    conn = pool.getconn()
+                except db.PoolTimeout as exc:
+                    errors.append(exc)
+                    continue
+                with lock:
+                    if conn in checked_out:
+                        errors.append(AssertionError("connection handed out twice"))
+                    checked_out.add(conn)
+                    if len(checked_out) > pool.maxconn:
+                        errors.append(AssertionError("more connections out than maxconn"))
+                time.sleep(0.01)
+                with lock:
+                    checked_out.discard(conn)
+                pool.putconn(conn)
+
+        threads = [threading.Thread(target=worker) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(pool.stats()["timeouts"], 0)
+        self.assertEqual(pool.stats()["size"], 3)
+        self.assert_quiescent(pool)
+
+    def test_timeout_leaves_counters_consistent(self):
+        pool = self.pool(maxconn=2, timeout=0.05)
+        a, b = pool.getconn(), pool.getconn()
+        with self.assertRaises(db.PoolTimeout):
+            pool.getconn()
+        stats = pool.stats()
+        self.assertEqual((stats["size"], stats["in_use"], stats["waiters"], stats["timeouts"]), (2, 2, 0, 1))
+        pool.putconn(a)
+        pool.putconn(b)
+        self.assert_quiescent(pool)
+
+    def test_released_connection_goes_to_oldest_waiter(self):
+        pool = self.pool(maxconn=1, timeout=2)
+        held = pool.getconn()
+        order = []
+        release = threading.Event()
+
+        def waiter(name):
+            conn = pool.getconn()
+            order.append(name)
+            release.wait()
+            pool.putconn(conn)
+
+        threads = []
+        for n, name in enumerate(["first", "second"], start=1):
+            threads.append(threading.Thread(target=waiter, args=(name,)))
+            threads[-1].start()
+            while pool.stats()["waiters"] < n:
+                time.sleep(0.001)
+
+        pool.putconn(held)
+        # The releasing thread cannot take the connection straight back: it
+        # went to "first", and "second" is ahead in the queue
+        pool.timeout = 0.05
+        with self.assertRaises(db.PoolTimeout):
+            pool.getconn()
+        self.assertEqual(order, ["first"])
+
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(order, ["first", "second"])
+        self.assert_quiescent(pool)
+
+    def test_discarded_connection_frees_a_slot_for_a_waiter(self):
+        pool = self.pool(maxconn=1, timeout=2)
+        held = pool.getconn()
+        got = []
+        t = threading.Thread(target=lambda: got.append(pool.getconn()))
+        t.start()
+        while pool.stats()["waiters"] < 1:
+            time.sleep(0.001)
+        held.close()
+        pool.putconn(held)
+        t.join()
+        self.assertIsNot(got[0], held)
+        stats = pool.stats()
+        self.assertEqual((stats["size"], stats["in_use"], stats["discarded"]), (1, 1, 1))
+        pool.putconn(got[0])
+        self.assert_quiescent(pool)
+
+    def test_closeall_closes_idle_connections(self):
+        pool = self.pool(maxconn=2, timeout=0.1)
+        conns = [pool.getconn(), pool.getconn()]
+        for conn in conns:
+            pool.putconn(conn)
+        pool.closeall()
+        self.assertTrue(all(conn.closed for conn in conns))
+        self.assertEqual(pool.stats()["size"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import re
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+try:
+    import tp_pipeline_dag as dag
+except ImportError:  # airflow / psycopg2 not installed
+    dag = None
+
+# Statements allowed once DETACH PARTITION has taken ACCESS EXCLUSIVE on
+# 'recommendations': partition DDL, its catalog lookups and the generation bump.
+AFTER_SWAP = re.compile(
+    r"^(ALTER TABLE recommendations (DETACH|ATTACH) PARTITION"
+    r"|DROP TABLE recommendations_\d{8}$"
+    r"|ALTER TABLE recommendations_\d{8}_staging RENAME"
+    r"|SELECT to_regclass"
+    r"|SELECT c\.relname FROM pg_inherits"
+    r"|LOCK TABLE recommendations_meta"
+    r"|INSERT INTO recommendations_meta)"
+)
+
+
+class RecordingCursor:
+    def __init__(self, log, partitions):
+        self.log = log
+        self.partitions = partitions
+
+    def execute(self, sql, params=None):
+        self.log.append(" ".join(sql.split()))
+
+    def fetchone(self):
+        return [True]
+
+    def fetchall(self):
+        return [(p,) for p in self.partitions]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class RecordingConnection:
+    def __init__(self, log, partitions):
+        self.log = log
+        self.partitions = partitions
+
+    def cursor(self):
+        return RecordingCursor(self.log, self.partitions)
+
+    def commit(self):
+        self.log.append("COMMIT")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def recomendaciones():
+    df = pd.DataFrame({
+        "advertiser_id": ["a", "b"],
+        "model": ["top_product", "top_ctr"],
+        "product_id": ["1", "2"],
+        "rank": [1, 1],
+        "views": [3, None],
+        "impressions": [None, 2],
+        "clicks": [None, 1],
+        "ctr": [None, 0.5],
+    })
+    df["date"] = "2025-12-03"
+    return df[dag.RECOMMENDATIONS_COLUMNS]
+
+
+@unittest.skipIf(dag is None, "the DAG needs airflow and psycopg2")
+class DbWritingOrderTest(unittest.TestCase):
+    def run_db_writing(self, partitioned, retention_days=0):
+        log = []
+        conn = RecordingConnection(log, ["recommendations_20250101", "recommendations_20251202"])
+        patches = [
+            mock.patch.object(dag, "conectar_db", lambda: conn),
+            mock.patch.object(dag, "combinar_recomendaciones", lambda d: recomendaciones()),
+            mock.patch.object(dag, "cargar_recomendaciones",
+                              lambda cur, df, tabla="recommendations": log.append(f"LOAD {tabla}")),
+            mock.patch.object(dag, "execute_values",
+                              lambda cur, sql, rows: log.append(" ".join(sql.split()))),
+            mock.patch.object(dag, "DB_PARTITIONED", partitioned),
+            mock.patch.object(dag, "RETENTION_DAYS", retention_days),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        dag.db_writing(ds="2025-12-03")
+        return log
+
+    def test_partition_swap_and_generation_come_last(self):
+        log = self.run_db_writing(partitioned=True, retention_days=30)
+        self.assertEqual(log[-1], "COMMIT")
+        swap = next(i for i, sql in enumerate(log) if "DETACH PARTITION" in sql)
+
+        before = log[:swap]
+        self.assertIn("LOAD recommendations_20251203_staging", before)
+        self.assertTrue(any(sql.startswith("INSERT INTO recommendations_payload") for sql in before))
+        self.assertTrue(any(sql.startswith("INSERT INTO recommendations_stats") for sql in before))
+
+        for sql in log[swap:-1]:
+            self.assertRegex(sql, AFTER_SWAP)
+        self.assertTrue(log[-2].startswith("INSERT INTO recommendations_meta"))
+        self.assertTrue(log[-3].startswith("LOCK TABLE recommendations_meta"))
+        # Expired partition dropped, the recent one kept
+        self.assertIn("DROP TABLE recommendations_20250101", log[swap:])
+        self.assertNotIn("DROP TABLE recommendations_20251202", log)
+
+    def test_unpartitioned_load_takes_no_partition_locks(self):
+        log = self.run_db_writing(partitioned=False)
+        self.assertFalse(any("PARTITION" in sql for sql in log))
+        self.assertIn("LOAD recommendations", log)
+        self.assertTrue(log[-2].startswith("INSERT INTO recommendations_meta"))
+        self.assertEqual(log[-1], "COMMIT")
+
+
+if __name__ == "__main__":
+    unittest.main()
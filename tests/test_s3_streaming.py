@@ -0,0 +1,83 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+try:
+    import tp_pipeline_dag as dag
+except ImportError:  # airflow / psycopg2 not installed
+    dag = None
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+BUCKET = "tp-streaming-test"
+
+
+def log_crudo(filas):
+    lineas = ["advertiser_id,product_id,type,date"]
+    for i in range(filas):
+        producto = i % 97 if i < filas // 2 else f"p{i % 89}"
+        lineas.append(f"adv{i % 7},{producto},{'click' if i % 5 == 0 else 'impression'},2025-12-03")
+    return ("\n".join(lineas) + "\n").encode("utf-8")
+
+
+@unittest.skipIf(dag is None or mock_aws is None, "needs airflow, psycopg2, boto3 and moto")
+class LectorS3PorRangosTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket=BUCKET)
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+        self.mock.stop()
+
+    def lector(self, key, part_size, max_concurrency=3):
+        return dag.LectorS3PorRangos(self.s3, BUCKET, key, part_size, max_concurrency)
+
+    def test_reads_are_byte_identical(self):
+        data = os.urandom(10_000)
+        self.s3.put_object(Bucket=BUCKET, Key="blob", Body=data)
+        for part_size in (97, 1000, 9_999, 10_000, 50_000):
+            with self.lector("blob", part_size) as origen:
+                self.assertEqual(io.BufferedReader(origen, 333).read(), data, part_size)
+
+    def test_empty_object(self):
+        self.s3.put_object(Bucket=BUCKET, Key="vacio", Body=b"")
+        with self.lector("vacio", 1024) as origen:
+            self.assertEqual(origen.read(), b"")
+
+    def test_filter_from_s3_matches_local_file(self):
+        data = log_crudo(5_000)
+        self.s3.put_object(Bucket=BUCKET, Key="product_views.csv", Body=data)
+        local = os.path.join(self.dir.name, "product_views.csv")
+        with open(local, "wb") as f:
+            f.write(data)
+        active_ids = pd.Index(["adv1", "adv3", "adv4"])
+        desde_s3 = os.path.join(self.dir.name, "desde_s3.parquet")
+        desde_disco = os.path.join(self.dir.name, "desde_disco.parquet")
+
+        # Small chunks, so numeric and alphanumeric product_ids land in different chunks
+        with mock.patch.object(dag, "FILTER_CHUNK_ROWS", 700):
+            with self.lector("product_views.csv", 4096) as origen:
+                filas = dag.filtrar_por_bloques(io.BufferedReader(origen, 4096), desde_s3, active_ids)
+            dag.filtrar_por_bloques(local, desde_disco, active_ids)
+
+        esperado = pd.read_csv(local, dtype=dag.TIPOS_IDS)
+        esperado = esperado[esperado["advertiser_id"].isin(active_ids)].reset_index(drop=True)
+        self.assertEqual(filas, len(esperado))
+        pd.testing.assert_frame_equal(dag.leer_intermedio(desde_s3), esperado)
+        pd.testing.assert_frame_equal(dag.leer_intermedio(desde_disco), esperado)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tp-api"))
+
+from app import snapshot  # noqa: E402
+
+try:
+    import tp_pipeline_dag as dag
+except ImportError:  # airflow / psycopg2 not installed
+    dag = None
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+
+def recomendaciones():
+    filas = [
+        ("adv-b", "top_product", "12", 1, 30, None, None, None),
+        ("adv-b", "top_product", "7", 2, 10, None, None, None),
+        ("adv-a", "top_ctr", "x9", 1, None, 10, 4, 0.4),
+        ("ádv-ñ", "top_ctr", "123", 1, None, 3, 0, 0.0),
+        ("adv-a", "top_product", "12", 1, 5, None, None, None),
+    ]
+    df = pd.DataFrame(filas, columns=[
+        "advertiser_id", "model", "product_id", "rank", "views", "impressions", "clicks", "ctr",
+    ])
+    df["date"] = "2025-12-03"
+    return df[dag.RECOMMENDATIONS_COLUMNS]
+
+
+@unittest.skipIf(dag is None, "the DAG needs airflow and psycopg2")
+class SnapshotRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "recommendations.snapshot")
+        dag.escribir_snapshot(recomendaciones(), "2025-12-03", self.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_layout_matches(self):
+        self.assertEqual(dag.SNAPSHOT_MAGIC, snapshot.MAGIC)
+        self.assertEqual(dag.SNAPSHOT_VERSION, snapshot.VERSION)
+        self.assertEqual(dag.SNAPSHOT_MODELS, snapshot.MODELS)
+        self.assertEqual(dag._SNAPSHOT_HEADER.format, snapshot._HEADER.format)
+        self.assertEqual(dag._SNAPSHOT_ENTRY.format, snapshot._ENTRY.format)
+        self.assertEqual(dag._SNAPSHOT_ROW.format, snapshot._ROW.format)
+
+    def test_lookup(self):
+        s = snapshot.Snapshot(self.path)
+        self.assertEqual((s.n_entries, s.n_rows), (4, 5))
+        self.assertEqual(s.lookup("adv-b", "top_product"), {
+            "advertiser_id": "adv-b",
+            "model": "top_product",
+            "date": "2025-12-03",
+            "recommendations": [
+                {"rank": 1, "product_id": "12", "views": 30},
+                {"rank": 2, "product_id": "7", "views": 10},
+            ],
+            "count": 2,
+        })
+        self.assertEqual(
+            s.lookup("adv-a", "top_ctr")["recommendations"],
+            [{"rank": 1, "product_id": "x9", "impressions": 10, "clicks": 4, "ctr": 0.4}],
+        )
+        self.assertEqual(s.lookup("ádv-ñ", "top_ctr")["count"], 1)
+        self.assertIsNone(s.lookup("adv-b", "top_ctr"))
+        self.assertIsNone(s.lookup("nope", "top_product"))
+
+    def test_lookup_matches_payloads(self):
+        # The snapshot and the pre-rendered payloads serve the same JSON
+        import json
+
+        s = snapshot.Snapshot(self.path)
+        for _, adv, model, payload in dag.renderizar_payloads(recomendaciones(), "2025-12-03"):
+            self.assertEqual(s.lookup(adv, model), json.loads(payload))
+
+    def test_truncated_file_is_rejected(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for size in (len(data) // 2, len(data) - 1, 10):
+            truncated = os.path.join(self.dir.name, f"truncated-{size}")
+            with open(truncated, "wb") as f:
+                f.write(data[:size])
+            with self.assertRaises(ValueError):
+                snapshot.Snapshot(truncated)
+
+    def test_corrupt_file_is_rejected(self):
+        with open(self.path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xFF]))
+        with self.assertRaises(ValueError):
+            snapshot.Snapshot(self.path)
+
+    def test_store_keeps_previous_snapshot(self):
+        store = snapshot.SnapshotStore(self.path)
+        self.assertIsNone(store.current())
+        self.assertTrue(store.refresh())
+        self.assertFalse(store.refresh())
+        self.assertIsNotNone(store.current().lookup("adv-b", "top_product"))
+        with open(self.path, "rb") as f:
+            data = f.read()
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data[: len(data) // 2])
+        os.replace(tmp, self.path)
+        self.assertFalse(store.refresh())
+        self.assertIsNotNone(store.current().lookup("adv-b", "top_product"))
+        self.assertEqual(store.swaps, 1)
+
+
+@unittest.skipIf(dag is None or mock_aws is None, "needs airflow, psycopg2, boto3 and moto")
+class SnapshotFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket="snapshots-test")
+        self.path = os.path.join(self.dir.name, "recommendations.snapshot")
+
+    def tearDown(self):
+        self.mock.stop()
+        self.dir.cleanup()
+
+    def _upload(self, data):
+        self.s3.put_object(Bucket="snapshots-test", Key="snapshots/recommendations.snapshot", Body=data)
+
+    def test_fetch_replaces_file_only_with_valid_snapshots(self):
+        origen = os.path.join(self.dir.name, "origen.snapshot")
+        dag.escribir_snapshot(recomendaciones(), "2025-12-03", origen)
+        with open(origen, "rb") as f:
+            data = f.read()
+
+        fetcher = snapshot.SnapshotFetcher("s3://snapshots-test/snapshots/recommendations.snapshot", self.path)
+        fetcher._client = self.s3
+        self._upload(data)
+        self.assertTrue(fetcher.fetch())
+        self.assertFalse(fetcher.fetch())
+        self.assertEqual(snapshot.Snapshot(self.path).n_rows, 5)
+
+        self._upload(data[: len(data) // 2])
+        with self.assertRaises(ValueError):
+            fetcher.fetch()
+        self.assertEqual(snapshot.Snapshot(self.path).n_rows, 5)
+        self.assertEqual(
+            sorted(os.listdir(self.dir.name)),
+            ["origen.snapshot", "recommendations.snapshot", "recommendations.snapshot.etag",
+             "recommendations.snapshot.lock"],
+        )
+        self.assertEqual((fetcher.downloads, fetcher.failures), (1, 1))
+
+    def test_workers_on_a_host_download_once(self):
+        origen = os.path.join(self.dir.name, "origen.snapshot")
+        dag.escribir_snapshot(recomendaciones(), "2025-12-03", origen)
+        with open(origen, "rb") as f:
+            self._upload(f.read())
+
+        uri = "s3://snapshots-test/snapshots/recommendations.snapshot"
+        fetchers = [snapshot.SnapshotFetcher(uri, self.path) for _ in range(3)]
+        for fetcher in fetchers:
+            fetcher._client = self.s3
+        self.assertEqual([f.fetch() for f in fetchers], [True, False, False])
+        inode = os.stat(self.path).st_ino
+        self.assertEqual([f.fetch() for f in fetchers], [False, False, False])
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+
+        dag.escribir_snapshot(recomendaciones().iloc[:2], "2025-12-04", origen)
+        with open(origen, "rb") as f:
+            self._upload(f.read())
+        self.assertEqual([f.fetch() for f in reversed(fetchers)], [True, False, False])
+        self.assertEqual(snapshot.Snapshot(self.path).n_rows, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache with per-entry TTL.
+
+    `None` is a valid cached value and is used for negative (404) results,
+    so lookups return `MISSING` when there is no usable entry.
+
+    Entries may be tagged with the data generation they were built from.
+    A lookup with a different generation is a miss, and tagged entries use
+    `generation_ttl` instead of `ttl` since they no longer go stale by age.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, negative_ttl: float, generation_ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.generation_ttl = generation_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, generation=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            value, expires_at, entry_generation = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+            if entry_generation != generation:
+                del self._data[key]
+                self.invalidations += 1
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        if self.max_entries <= 0:
+            return
+        if value is None:
+            ttl = self.negative_ttl
+        elif generation is not None:
+            ttl = self.generation_ttl
+        else:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl, generation)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "negative_ttl_seconds": self.negative_ttl,
+                "generation_ttl_seconds": self.generation_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+class GenerationTracker:
+    """Caches the pipeline's data generation marker.
+
+    `fetch` is a coroutine function returning the current generation (or
+    None). It is awaited at most once per `poll_interval` seconds; in
+    between, the last value is reused. If the marker cannot be read,
+    `current()` returns None and callers fall back to plain TTL expiry.
+    """
+
+    def __init__(self, fetch, poll_interval: float):
+        self._fetch = fetch
+        self.poll_interval = poll_interval
+        self._generation = None
+        self._checked_at = None
+        self._lock = asyncio.Lock()
+
+    def _fresh(self):
+        return self._checked_at is not None and time.monotonic() - self._checked_at < self.poll_interval
+
+    async def current(self):
+        if self.poll_interval <= 0:
+            return None
+        if self._fresh():
+            return self._generation
+        async with self._lock:
+            if self._fresh():
+                return self._generation
+            try:
+                self._generation = await self._fetch()
+            except Exception:
+                log.warning("Could not read data generation marker; using TTL expiry", exc_info=True)
+                self._generation = None
+            self._checked_at = time.monotonic()
+            return self._generation
+
+
+recommendations_cache = TTLCache(
+    max_entries=int(os.environ.get("CACHE_MAX_ENTRIES", "10000")),
+    ttl=float(os.environ.get("CACHE_TTL_SECONDS", "300")),
+    negative_ttl=float(os.environ.get("CACHE_NEGATIVE_TTL_SECONDS", "30")),
+    generation_ttl=float(os.environ.get("CACHE_GENERATION_TTL_SECONDS", "86400")),
+)
@@ -1,41 +1,273 @@
 import os
-from psycopg2.pool import SimpleConnectionPool
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+from app.statements import Statement, to_positional
+
+PREPARE_STATEMENTS = os.environ.get("DB_PREPARE", "1") == "1"
 
 _pool = None
+_pool_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class _Waiter:
+    __slots__ = ("event", "conn", "last_used", "granted")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.conn = None
+        self.last_used = None
+        self.granted = False
+
+
+class BoundedConnectionPool:
+    """Thread-safe psycopg2 pool with a bounded size and a FIFO wait queue.
+
+    `getconn` blocks up to `timeout` seconds for a free connection instead
+    of failing as soon as `maxconn` are checked out. Waiters are served in
+    arrival order: a released connection (or a freed slot) is handed
+    directly to the oldest waiter, so a thread that just released one
+    cannot take it straight back while others wait. Connections older than
+    `max_lifetime` or idle for longer than `max_idle` are closed instead of
+    reused, and connections idle for more than `check_after` seconds are
+    pinged before being handed out.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, max_lifetime, max_idle, check_after, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self._connect_kwargs = connect_kwargs
+        self._lock = threading.Lock()
+        self._idle = deque()
+        self._waiters = deque()
+        self._born = {}
+        self._prepared = {}
+        self._size = 0
+        self._in_use = 0
+        self.timeouts = 0
+        self.discarded = 0
+        for _ in range(minconn):
+            self._size += 1
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._connect_kwargs)
+        self._born[conn] = time.monotonic()
+        return conn
+
+    def _expired(self, conn, last_used, now):
+        if conn.closed:
+            return True
+        if self.max_lifetime > 0 and now - self._born[conn] > self.max_lifetime:
+            return True
+        return self.max_idle > 0 and now - last_used > self.max_idle
+
+    def _discard(self, conn):
+        self._born.pop(conn, None)
+        self._prepared.pop(conn, None)
+        self.discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _grant(self, conn, last_used):
+        # Caller holds the lock. Hands `conn` (or, if None, a new slot) to the
+        # oldest waiter; returns False if nobody is waiting.
+        if not self._waiters:
+            return False
+        waiter = self._waiters.popleft()
+        waiter.conn, waiter.last_used, waiter.granted = conn, last_used, True
+        self._in_use += 1
+        if conn is None:
+            self._size += 1
+        waiter.event.set()
+        return True
+
+    def _acquire(self, deadline):
+        # Returns (conn, last_used) for an idle connection, or (None, None)
+        # when a slot was reserved for the caller to open a new one.
+        with self._lock:
+            if not self._waiters:
+                now = time.monotonic()
+                while self._idle:
+                    conn, last_used = self._idle.pop()
+                    if self._expired(conn, last_used, now):
+                        self._size -= 1
+                        self._discard(conn)
+                        continue
+                    self._in_use += 1
+                    return conn, last_used
+                if self._size < self.maxconn:
+                    self._size += 1
+                    self._in_use += 1
+                    return None, None
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+        waiter.event.wait(max(0.0, deadline - time.monotonic()))
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                self.timeouts += 1
+                raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        return waiter.conn, waiter.last_used
+
+    def _release_slot(self):
+        with self._lock:
+            self._size -= 1
+            self._in_use -= 1
+            self._grant(None, None)
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn, last_used = self._acquire(deadline)
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+            if self._healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+            self._release_slot()
+
+    def prepared_statements(self, conn):
+        """Statement name -> parameter order for statements PREPAREd on `conn`."""
+        return self._prepared.setdefault(conn, {})
+
+    def putconn(self, conn):
+        now = time.monotonic()
+        if not conn.closed:
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                conn.close()
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+            if conn.closed or (self.max_lifetime > 0 and now - self._born[conn] > self.max_lifetime):
+                self._size -= 1
+                self._discard(conn)
+                self._grant(None, None)
+            elif not self._grant(conn, now):
+                self._idle.append((conn, now))
+
+    def closeall(self):
+        with self._lock:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiters": len(self._waiters),
+                "timeouts": self.timeouts,
+                "discarded": self.discarded,
+            }
+
 
 def get_pool():
     global _pool
     if _pool is None:
-        _pool = SimpleConnectionPool(
-            minconn=1,
-            maxconn=5,
-            host=os.environ["DB_HOST"],
-            port=int(os.environ.get("DB_PORT", "5432")),
-            dbname=os.environ.get("DB_NAME", "postgres"),
-            user=os.environ["DB_USER"],
-            password=os.environ["DB_PASSWORD"],
-            connect_timeout=5,
-        )
+        with _pool_lock:
+            if _pool is None:
+                _pool = BoundedConnectionPool(
+                    minconn=int(os.environ.get("DB_POOL_MIN", "1")),
+                    maxconn=int(os.environ.get("DB_POOL_MAX", "5")),
+                    timeout=float(os.environ.get("DB_POOL_TIMEOUT", "2")),
+                    max_lifetime=float(os.environ.get("DB_POOL_MAX_LIFETIME", "3600")),
+                    max_idle=float(os.environ.get("DB_POOL_MAX_IDLE", "600")),
+                    check_after=float(os.environ.get("DB_POOL_CHECK_AFTER", "30")),
+                    host=os.environ["DB_HOST"],
+                    port=int(os.environ.get("DB_PORT", "5432")),
+                    dbname=os.environ.get("DB_NAME", "postgres"),
+                    user=os.environ["DB_USER"],
+                    password=os.environ["DB_PASSWORD"],
+                    connect_timeout=5,
+                )
     return _pool
 
-def fetch_all(sql: str, params: tuple = ()):
+def pool_stats():
+    return get_pool().stats()
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+def _execute(pool, conn, cur, sql, params):
+    if not isinstance(sql, Statement):
+        cur.execute(sql, params)
+        return
+    if not PREPARE_STATEMENTS:
+        cur.execute(sql.sql, params)
+        return
+    prepared = pool.prepared_statements(conn)
+    arg_names = prepared.get(sql.name)
+    if arg_names is None:
+        text, arg_names = to_positional(sql.sql)
+        cur.execute(f"PREPARE {sql.name} AS {text}")
+        prepared[sql.name] = arg_names
+    if arg_names:
+        placeholders = ", ".join(["%s"] * len(arg_names))
+        cur.execute(f"EXECUTE {sql.name} ({placeholders})", [params[n] for n in arg_names])
+    else:
+        cur.execute(f"EXECUTE {sql.name}")
+
+def fetch_all(sql, params=()):
     pool = get_pool()
     conn = pool.getconn()
     try:
         with conn.cursor() as cur:
-            cur.execute(sql, params)
+            _execute(pool, conn, cur, sql, params)
             rows = cur.fetchall()
             cols = [d[0] for d in cur.description]
             return [dict(zip(cols, r)) for r in rows]
     finally:
         pool.putconn(conn)
 
-def fetch_one(sql: str, params: tuple = ()):
+def fetch_one(sql, params=()):
     pool = get_pool()
     conn = pool.getconn()
     try:
         with conn.cursor() as cur:
-            cur.execute(sql, params)
+            _execute(pool, conn, cur, sql, params)
             row = cur.fetchone()
             if row is None:
                 return None
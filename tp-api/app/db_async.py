@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+import weakref
+
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+from app.statements import Statement
+
+PREPARE_STATEMENTS = os.environ.get("DB_PREPARE", "1") == "1"
+CHECK_AFTER = float(os.environ.get("DB_POOL_CHECK_AFTER", "30"))
+
+_pool = None
+_pool_lock = asyncio.Lock()
+_last_used = weakref.WeakKeyDictionary()
+
+async def _mark_used(conn):
+    _last_used[conn] = time.monotonic()
+
+async def _check(conn):
+    # Like the sync pool: only ping connections idle for more than CHECK_AFTER
+    # seconds, so the hot path gets no extra round trip.
+    last_used = _last_used.get(conn)
+    if last_used is not None and time.monotonic() - last_used > CHECK_AFTER:
+        await AsyncConnectionPool.check_connection(conn)
+
+async def get_pool():
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                pool = AsyncConnectionPool(
+                    kwargs={
+                        "host": os.environ["DB_HOST"],
+                        "port": int(os.environ.get("DB_PORT", "5432")),
+                        "dbname": os.environ.get("DB_NAME", "postgres"),
+                        "user": os.environ["DB_USER"],
+                        "password": os.environ["DB_PASSWORD"],
+                        "connect_timeout": 5,
+                        # DB_PREPARE=0 is for transaction-pooling proxies: never prepare server-side
+                        **({} if PREPARE_STATEMENTS else {"prepare_threshold": None}),
+                    },
+                    min_size=int(os.environ.get("DB_POOL_MIN", "1")),
+                    max_size=int(os.environ.get("DB_POOL_MAX", "5")),
+                    timeout=float(os.environ.get("DB_POOL_TIMEOUT", "2")),
+                    max_lifetime=float(os.environ.get("DB_POOL_MAX_LIFETIME", "3600")),
+                    max_idle=float(os.environ.get("DB_POOL_MAX_IDLE", "600")),
+                    check=_check,
+                    reset=_mark_used,
+                    open=False,
+                )
+                await pool.open()
+                _pool = pool
+    return _pool
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+async def pool_stats():
+    pool = await get_pool()
+    s = pool.get_stats()
+    return {
+        "min": s["pool_min"],
+        "max": s["pool_max"],
+        "size": s["pool_size"],
+        "in_use": s["pool_size"] - s["pool_available"],
+        "idle": s["pool_available"],
+        "waiters": s.get("requests_waiting", 0),
+        "timeouts": s.get("requests_errors", 0),
+        "discarded": s.get("connections_lost", 0),
+    }
+
+async def _execute(cur, sql, params):
+    if isinstance(sql, Statement):
+        # psycopg3 keeps a per-connection cache of server-side prepared statements
+        await cur.execute(sql.sql, params, prepare=PREPARE_STATEMENTS)
+    else:
+        await cur.execute(sql, params)
+
+async def fetch_all(sql, params=()):
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await _execute(cur, sql, params)
+            return await cur.fetchall()
+
+async def fetch_one(sql, params=()):
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await _execute(cur, sql, params)
+            return await cur.fetchone()
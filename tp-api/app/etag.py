@@ -0,0 +1,25 @@
+import hashlib
+from typing import Optional
+
+from fastapi.responses import Response
+
+
+def make_etag(*parts) -> str:
+    """Strong ETag for a response fully determined by `parts`."""
+    digest = hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=12).hexdigest()
+    return f'"{digest}"'
+
+def body_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str, wildcard: bool = True) -> bool:
+    # If-None-Match uses weak comparison, so W/"x" matches "x". "*" matches any
+    # current representation; pass wildcard=False until the resource is known to exist.
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return wildcard
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def not_modified(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
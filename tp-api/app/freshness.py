@@ -0,0 +1,39 @@
+import os
+from datetime import date, datetime, timedelta, timezone
+
+# The pipeline DAG runs daily at PIPELINE_RUN_HOUR_UTC (schedule "0 0 * * *"),
+# writes the previous day's date (Airflow's ds) and usually finishes within
+# PIPELINE_EXPECTED_DURATION_SECONDS.
+PIPELINE_RUN_HOUR_UTC = int(os.environ.get("PIPELINE_RUN_HOUR_UTC", "0"))
+PIPELINE_EXPECTED_DURATION = timedelta(seconds=float(os.environ.get("PIPELINE_EXPECTED_DURATION_SECONDS", "3600")))
+# Floor for max-age, also used when the expected run has not landed yet.
+MIN_MAX_AGE = int(os.environ.get("CACHE_CONTROL_MIN_MAX_AGE", "60"))
+STALE_WHILE_REVALIDATE = int(os.environ.get("CACHE_CONTROL_STALE_WHILE_REVALIDATE", "300"))
+STALE_IF_ERROR = int(os.environ.get("CACHE_CONTROL_STALE_IF_ERROR", "86400"))
+
+
+def next_pipeline_completion(now: datetime) -> datetime:
+    done = now.replace(hour=PIPELINE_RUN_HOUR_UTC, minute=0, second=0, microsecond=0) + PIPELINE_EXPECTED_DURATION
+    while done <= now:
+        done += timedelta(days=1)
+    return done
+
+def cache_control(data_date: date = None, now: datetime = None) -> str:
+    """Cache-Control for data that next changes when the pipeline's next run lands.
+
+    If `data_date` is older than what the last expected run should have
+    written, the run is late and max-age is kept at the floor so caches
+    pick the new data up soon after it lands.
+    """
+    now = now or datetime.now(timezone.utc)
+    done = next_pipeline_completion(now)
+    max_age = int((done - now).total_seconds())
+    if data_date is not None:
+        last_run = done - timedelta(days=1) - PIPELINE_EXPECTED_DURATION
+        if data_date < last_run.date() - timedelta(days=1):
+            max_age = MIN_MAX_AGE
+    max_age = max(max_age, MIN_MAX_AGE)
+    return (
+        f"public, max-age={max_age}, "
+        f"stale-while-revalidate={STALE_WHILE_REVALIDATE}, stale-if-error={STALE_IF_ERROR}"
+    )
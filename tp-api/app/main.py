@@ -1,42 +1,218 @@
-from fastapi import FastAPI, HTTPException
-from app.db import fetch_one, fetch_all
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timezone
+from typing import List
 
-app = FastAPI(title="TP MLOps - Recommendations API", version="1.0.0")
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+from app.cache import MISSING, GenerationTracker, recommendations_cache
+from app.etag import body_etag, etag_matches, make_etag, not_modified
+from app.freshness import cache_control
+from app.responses import FastJSONResponse
+from app.schema import verify_schema
+from app.singleflight import SingleFlight
+from app.snapshot import SnapshotFetcher, SnapshotStore
+from app.statements import (
+    GENERATION,
+    HISTORY,
+    HISTORY_DOCUMENT,
+    LATEST_PAYLOAD,
+    LATEST_PAYLOAD_BATCH,
+    LATEST_RECOMMENDATIONS,
+    LATEST_RECOMMENDATIONS_BATCH,
+    STATS,
+    STATS_SUMMARY,
+)
+
+DB_ASYNC = os.environ.get("DB_ASYNC", "1") == "1"
+
+if DB_ASYNC:
+    from psycopg.errors import UndefinedTable
+    from psycopg_pool import PoolTimeout
+    from app.db_async import close_pool, fetch_one, fetch_all, pool_stats
+else:
+    from app import db
+    from app.db import PoolTimeout
+    from psycopg2.errors import UndefinedTable
+
+    async def pool_stats():
+        return db.pool_stats()
+
+    async def close_pool():
+        db.close_pool()
+
+    async def fetch_one(sql, params=()):
+        return await run_in_threadpool(db.fetch_one, sql, params)
+
+    async def fetch_all(sql, params=()):
+        return await run_in_threadpool(db.fetch_all, sql, params)
+
+log = logging.getLogger(__name__)
+
+# Snapshot mode can run without RDS; everything that would open the pool checks this first.
+DATABASE_CONFIGURED = bool(os.environ.get("DB_HOST"))
+
+# "warn": log a schema mismatch at startup; "strict": refuse to start; "off": skip the check.
+SCHEMA_CHECK = os.environ.get("SCHEMA_CHECK", "warn")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if SCHEMA_CHECK != "off" and DATABASE_CONFIGURED:
+        try:
+            await verify_schema(fetch_one)
+        except Exception:
+            if SCHEMA_CHECK == "strict":
+                raise
+            log.warning("Database schema check failed", exc_info=True)
+    poller = None
+    if RECOMMENDATIONS_SOURCE == "snapshot":
+        if snapshot_fetcher is not None:
+            await _fetch_snapshot()
+        await run_in_threadpool(snapshot_store.refresh)
+        poller = asyncio.create_task(_poll_snapshot())
+    yield
+    if poller is not None:
+        poller.cancel()
+    await close_pool()
+
+app = FastAPI(
+    title="TP MLOps - Recommendations API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
+)
 
 ALLOWED_MODELS = {"top_product", "top_ctr"}
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "200"))
+
+# "rows": shape responses from the recommendations table.
+# "payload": serve the JSON pre-rendered by the pipeline in recommendations_payload.
+# "snapshot": serve from the pipeline's memory-mapped snapshot file, no DB involved.
+RECOMMENDATIONS_SOURCE = os.environ.get("RECOMMENDATIONS_SOURCE", "rows")
+
+# Have Postgres build the /history document (json_agg) instead of nesting rows here.
+HISTORY_JSON_AGG = os.environ.get("HISTORY_JSON_AGG", "1") == "1"
+
+snapshot_store = SnapshotStore(os.environ.get("SNAPSHOT_PATH", "/data/recommendations.snapshot"))
+SNAPSHOT_CHECK_SECONDS = float(os.environ.get("SNAPSHOT_CHECK_SECONDS", "5"))
+
+# Where the pipeline uploads the snapshot, e.g. s3://bucket/snapshots/recommendations.snapshot.
+# Leave unset only if something else keeps SNAPSHOT_PATH up to date (atomically, via rename).
+SNAPSHOT_S3_URI = os.environ.get("SNAPSHOT_S3_URI")
+SNAPSHOT_FETCH_SECONDS = float(os.environ.get("SNAPSHOT_FETCH_SECONDS", "60"))
+snapshot_fetcher = (
+    SnapshotFetcher(SNAPSHOT_S3_URI, snapshot_store.path)
+    if RECOMMENDATIONS_SOURCE == "snapshot" and SNAPSHOT_S3_URI
+    else None
+)
+
+async def _fetch_snapshot():
+    try:
+        await run_in_threadpool(snapshot_fetcher.fetch)
+    except Exception:
+        log.warning("Could not fetch snapshot from %s", SNAPSHOT_S3_URI, exc_info=True)
+
+async def _poll_snapshot():
+    # Loading a new snapshot maps and checksums the whole file, so it happens
+    # here in the threadpool; requests only read snapshot_store.current().
+    fetched_at = time.monotonic()
+    while True:
+        await asyncio.sleep(SNAPSHOT_CHECK_SECONDS)
+        if snapshot_fetcher is not None and time.monotonic() - fetched_at >= SNAPSHOT_FETCH_SECONDS:
+            await _fetch_snapshot()
+            fetched_at = time.monotonic()
+        await run_in_threadpool(snapshot_store.refresh)
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    return JSONResponse(status_code=503, content={"detail": "Database busy, retry shortly"}, headers={"Retry-After": "1"})
+
+async def _fetch_generation():
+    if RECOMMENDATIONS_SOURCE == "snapshot":
+        snapshot = snapshot_store.current()
+        return snapshot.identity if snapshot else None
+    row = await fetch_one(GENERATION)
+    return row["generation"] if row else None
+
+# One in-flight load per (adv, model, generation); concurrent misses share it.
+recommendations_flight = SingleFlight()
+
+data_generation = GenerationTracker(
+    _fetch_generation,
+    poll_interval=float(os.environ.get("CACHE_GENERATION_POLL_SECONDS", "10")),
+)
 
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok"}
 
 @app.get("/recommendations/{adv}/{model}")
-def recommendations(adv: str, model: str):
+async def recommendations(adv: str, model: str, request: Request):
     model = model.lower()
     if model not in ALLOWED_MODELS:
         raise HTTPException(status_code=400, detail=f"Invalid model. Use: {sorted(ALLOWED_MODELS)}")
 
-    latest = fetch_one(
-        """
-        SELECT MAX(date) AS max_date
-        FROM recommendations
-        WHERE advertiser_id = %s AND model = %s
-        """,
-        (adv, model),
-    )
-    if not latest or latest["max_date"] is None:
+    key = (adv, model)
+    generation = await data_generation.current()
+    payload = recommendations_cache.get(key, generation)
+    # With a known generation the ETag is settled before touching the database.
+    etag = make_etag("recommendations", adv, model, generation) if generation is not None else None
+    if etag and etag_matches(request.headers.get("if-none-match"), etag, wildcard=False):
+        return not_modified(_cache_headers(etag, _payload_date(payload)))
+
+    if payload is MISSING:
+        payload = await recommendations_flight.do((adv, model, generation), _load_and_cache, adv, model, generation)
+    if payload is None:
         raise HTTPException(status_code=404, detail="No recommendations found for advertiser/model")
 
-    day = latest["max_date"]
+    if etag is None:
+        if isinstance(payload, bytes):
+            etag = body_etag(payload)
+        else:
+            etag = make_etag("recommendations", adv, model, payload["date"])
+    headers = _cache_headers(etag, _payload_date(payload))
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(headers)
+    return FastJSONResponse(payload, headers=headers)
 
-    rows = fetch_all(
-        """
-        SELECT date, advertiser_id, model, product_id, rank, views, impressions, clicks, ctr
-        FROM recommendations
-        WHERE advertiser_id = %s AND model = %s AND date = %s
-        ORDER BY rank ASC
-        """,
-        (adv, model, day),
-    )
+def _payload_date(payload):
+    # Pre-rendered payloads are not parsed just for this.
+    return date.fromisoformat(payload["date"]) if isinstance(payload, dict) else None
+
+def _cache_headers(etag: str, data_date: date = None):
+    return {"ETag": etag, "Cache-Control": cache_control(data_date)}
+
+async def _load_and_cache(adv: str, model: str, generation):
+    payload = await _load_recommendations(adv, model)
+    recommendations_cache.set((adv, model), payload, generation)
+    return payload
+
+def _current_snapshot():
+    snapshot = snapshot_store.current()
+    if snapshot is None:
+        raise HTTPException(status_code=503, detail="Recommendations snapshot not available")
+    return snapshot
+
+async def _load_recommendations(adv: str, model: str):
+    if RECOMMENDATIONS_SOURCE == "snapshot":
+        return _current_snapshot().lookup(adv, model)
+    if RECOMMENDATIONS_SOURCE == "payload":
+        row = await fetch_one(LATEST_PAYLOAD, {"adv": adv, "model": model})
+        return row["payload"].encode() if row else None
+
+    rows = await fetch_all(LATEST_RECOMMENDATIONS, {"adv": adv, "model": model})
+    if not rows:
+        return None
+    return _shape_recommendations(adv, model, rows)
+
+def _shape_recommendations(adv: str, model: str, rows):
+    day = rows[0]["date"]
 
     recs = []
     for r in rows:
@@ -51,21 +227,97 @@ def recommendations(adv: str, model: str):
 
     return {"advertiser_id": adv, "model": model, "date": str(day), "recommendations": recs, "count": len(recs)}
 
+class BatchItem(BaseModel):
+    advertiser_id: str
+    model: str
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem] = Field(..., min_length=1)
+
+@app.post("/recommendations:batch")
+async def recommendations_batch(body: BatchRequest):
+    if len(body.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many items, max is {BATCH_MAX_ITEMS}")
+
+    generation = await data_generation.current()
+    results = {}
+    pending = []
+    for item in body.items:
+        adv, model = item.advertiser_id, item.model.lower()
+        if model not in ALLOWED_MODELS:
+            results.setdefault(adv, {})[item.model] = {
+                "error": {"status": 400, "detail": f"Invalid model. Use: {sorted(ALLOWED_MODELS)}"}
+            }
+            continue
+        payload = recommendations_cache.get((adv, model), generation)
+        if payload is MISSING:
+            pending.append((adv, model))
+        results.setdefault(adv, {})[model] = payload
+
+    if pending:
+        for key, payload in (await _load_recommendations_batch(pending)).items():
+            recommendations_cache.set(key, payload, generation)
+            results[key[0]][key[1]] = payload
+
+    for by_model in results.values():
+        for model, payload in by_model.items():
+            if payload is None:
+                by_model[model] = {
+                    "error": {"status": 404, "detail": "No recommendations found for advertiser/model"}
+                }
+            elif isinstance(payload, bytes):
+                by_model[model] = orjson.Fragment(payload)
+
+    return FastJSONResponse({"results": results, "count": len(body.items)})
+
+async def _load_recommendations_batch(pending):
+    if RECOMMENDATIONS_SOURCE == "snapshot":
+        snapshot = _current_snapshot()
+        return {(adv, model): snapshot.lookup(adv, model) for adv, model in pending}
+
+    # Parallel lists: the statements unnest them into the exact (adv, model) pairs
+    params = {"advs": [adv for adv, _ in pending], "models": [model for _, model in pending]}
+    if RECOMMENDATIONS_SOURCE == "payload":
+        rows = await fetch_all(LATEST_PAYLOAD_BATCH, params)
+        found = {(r["advertiser_id"], r["model"]): r["payload"].encode() for r in rows}
+        return {key: found.get(key) for key in pending}
+
+    rows = await fetch_all(LATEST_RECOMMENDATIONS_BATCH, params)
+    grouped = {}
+    for r in rows:
+        grouped.setdefault((r["advertiser_id"], r["model"]), []).append(r)
+    return {
+        (adv, model): _shape_recommendations(adv, model, grouped[(adv, model)]) if (adv, model) in grouped else None
+        for adv, model in pending
+    }
+
 @app.get("/history/{adv}")
-def history(adv: str):
-    rows = fetch_all(
-        """
-        SELECT date, model, product_id, rank, views, impressions, clicks, ctr
-        FROM recommendations
-        WHERE advertiser_id = %s
-          AND date >= CURRENT_DATE - INTERVAL '7 days'
-        ORDER BY date DESC, model ASC, rank ASC
-        """,
-        (adv,),
-    )
-    if not rows:
+async def history(adv: str, request: Request):
+    # The 7-day window moves daily even without a new pipeline run; the
+    # statements anchor it on the UTC date too.
+    today = datetime.now(timezone.utc).date()
+    generation = await data_generation.current()
+    etag = make_etag("history", adv, today, generation) if generation is not None else None
+    if etag and etag_matches(request.headers.get("if-none-match"), etag, wildcard=False):
+        return not_modified(_cache_headers(etag))
+
+    if HISTORY_JSON_AGG:
+        row = await fetch_one(HISTORY_DOCUMENT, {"adv": adv})
+        latest = row["latest"]
+    else:
+        rows = await fetch_all(HISTORY, {"adv": adv})
+        latest = max(r["date"] for r in rows) if rows else None
+    if latest is None:
         raise HTTPException(status_code=404, detail="No history found for advertiser in last 7 days")
 
+    if etag is None:
+        etag = make_etag("history", adv, today, latest)
+    headers = _cache_headers(etag, latest)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(headers)
+    if HISTORY_JSON_AGG:
+        return FastJSONResponse(row["document"].encode(), headers=headers)
+
     out = {}
     for r in rows:
         d = str(r["date"])
@@ -79,18 +331,33 @@ def history(adv: str):
             "ctr": r["ctr"],
         })
 
-    return {"advertiser_id": adv, "history": out}
+    return FastJSONResponse({"advertiser_id": adv, "history": out}, headers=headers)
 
 @app.get("/stats")
-def stats():
-    s = fetch_one(
-        """
-        SELECT
-          COUNT(DISTINCT advertiser_id) AS advertisers_total,
-          COUNT(*) AS rows_total,
-          MAX(date) AS max_date,
-          MIN(date) AS min_date
-        FROM recommendations
-        """
-    )
-    return {"stats": s}
+async def stats(exact: bool = False):
+    # exact=true scans the whole recommendations table; so does a database
+    # the pipeline has not migrated to the summary table yet.
+    s = None
+    if not exact:
+        try:
+            s = await fetch_one(STATS_SUMMARY)
+        except UndefinedTable:
+            pass
+    if s is None:
+        s = await fetch_one(STATS)
+    return FastJSONResponse({"stats": s})
+
+@app.get("/metrics")
+async def metrics():
+    out = {
+        "cache": recommendations_cache.stats(),
+        "singleflight": recommendations_flight.stats(),
+        "generation": await data_generation.current(),
+    }
+    if DATABASE_CONFIGURED:
+        out["pool"] = await pool_stats()
+    if RECOMMENDATIONS_SOURCE == "snapshot":
+        out["snapshot"] = snapshot_store.stats()
+        if snapshot_fetcher is not None:
+            out["snapshot"]["fetch"] = snapshot_fetcher.stats()
+    return FastJSONResponse(out)
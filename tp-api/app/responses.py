@@ -0,0 +1,24 @@
+from decimal import Decimal
+
+import orjson
+from fastapi.responses import JSONResponse
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson.
+
+    Dates and datetimes are serialized natively and Decimals as floats.
+    Returning an instance directly from an endpoint skips FastAPI's
+    jsonable_encoder pass. Content that is already serialized (bytes) is
+    sent as is; embed it in a larger document with `orjson.Fragment`.
+    """
+
+    def render(self, content) -> bytes:
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            return bytes(content)
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
@@ -0,0 +1,26 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+# Migrations live in tp_schema.py and are applied by the pipeline; keep in sync.
+EXPECTED_SCHEMA_VERSION = 5
+REQUIRED_INDEXES = ("recommendations_lookup_idx",)
+
+
+class SchemaMismatch(RuntimeError):
+    pass
+
+
+async def verify_schema(fetch_one):
+    """Check the pipeline has migrated the database to what this API expects."""
+    row = await fetch_one("SELECT to_regclass('schema_migrations') IS NOT NULL AS present")
+    version = 0
+    if row["present"]:
+        row = await fetch_one("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations")
+        version = row["version"]
+    if version < EXPECTED_SCHEMA_VERSION:
+        raise SchemaMismatch(f"Database schema is at version {version}, expected {EXPECTED_SCHEMA_VERSION}")
+    for index in REQUIRED_INDEXES:
+        row = await fetch_one("SELECT to_regclass(%(name)s) IS NOT NULL AS present", {"name": index})
+        if not row["present"]:
+            raise SchemaMismatch(f"Missing index {index}")
@@ -0,0 +1,224 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from datetime import date
+
+log = logging.getLogger(__name__)
+
+# Binary layout written by generar_snapshot() in tp_pipeline_dag.py; keep both in
+# sync (tests/test_snapshot_roundtrip.py checks it).
+# Header: magic, version, flags, date ordinal, entries, rows, index/rows/strings
+# offsets, total file size and CRC32 of everything after the header.
+MAGIC = b"TPRS"
+VERSION = 2
+MODELS = {"top_product": 0, "top_ctr": 1}
+_HEADER = struct.Struct("<4sHHiIIQQQQI")
+_ENTRY = struct.Struct("<IIB3xII")
+_ROW = struct.Struct("<IIIqqqd")
+
+
+class Snapshot:
+    """Read-only view of one snapshot file, memory-mapped.
+
+    Lookups binary-search the (advertiser, model) index directly in the
+    mapping, so workers share the file through the page cache instead of
+    each holding its own copy.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if len(self._mm) < _HEADER.size:
+            raise ValueError(f"Snapshot file {path} is too short for a header")
+        (magic, version, flags, ordinal, self.n_entries, self.n_rows,
+         self._index_offset, self._rows_offset, self._strings_offset,
+         size, crc) = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unsupported snapshot file {path}: magic={magic!r} version={version}")
+        self._validate(path, size, crc)
+        self.date = date.fromordinal(ordinal)
+
+    def _validate(self, path: str, size: int, crc: int):
+        # A truncated or corrupt file must fail here, not turn every lookup into a 404.
+        if size != len(self._mm):
+            raise ValueError(f"Snapshot file {path} is {len(self._mm)} bytes, header says {size}")
+        if (self._index_offset != _HEADER.size
+                or self._rows_offset != self._index_offset + self.n_entries * _ENTRY.size
+                or self._strings_offset != self._rows_offset + self.n_rows * _ROW.size
+                or self._strings_offset > size):
+            raise ValueError(f"Snapshot file {path} has inconsistent section offsets")
+        with memoryview(self._mm) as view, view[_HEADER.size:] as body:
+            if zlib.crc32(body) != crc:
+                raise ValueError(f"Snapshot file {path} failed its checksum")
+
+    def _string(self, offset: int, length: int) -> bytes:
+        start = self._strings_offset + offset
+        return self._mm[start:start + length]
+
+    def _find(self, adv: bytes, model_code: int):
+        lo, hi = 0, self.n_entries
+        target = (adv, model_code)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            adv_offset, adv_len, code, row_start, row_count = _ENTRY.unpack_from(
+                self._mm, self._index_offset + mid * _ENTRY.size
+            )
+            key = (self._string(adv_offset, adv_len), code)
+            if key == target:
+                return row_start, row_count
+            if key < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def lookup(self, adv: str, model: str):
+        found = self._find(adv.encode("utf-8"), MODELS[model])
+        if found is None:
+            return None
+        row_start, row_count = found
+
+        recs = []
+        for i in range(row_start, row_start + row_count):
+            prod_offset, prod_len, rank, views, impressions, clicks, ctr = _ROW.unpack_from(
+                self._mm, self._rows_offset + i * _ROW.size
+            )
+            # product_id is TEXT in the database; serve it as a string like the other sources
+            item = {"rank": rank, "product_id": self._string(prod_offset, prod_len).decode("utf-8")}
+            if model == "top_product":
+                item["views"] = views
+            else:
+                item["impressions"] = impressions
+                item["clicks"] = clicks
+                item["ctr"] = ctr
+            recs.append(item)
+
+        return {"advertiser_id": adv, "model": model, "date": str(self.date), "recommendations": recs, "count": len(recs)}
+
+
+class SnapshotStore:
+    """Holds the current Snapshot and swaps in a new one when the file changes.
+
+    The file is replaced atomically (write + rename), so a new inode/mtime
+    means a complete new snapshot. `refresh()` stats the file and maps and
+    validates a new one; it does blocking I/O over the whole file, so run
+    it off the event loop. `current()` never touches the file. Readers
+    holding the previous Snapshot keep a valid mapping until they drop it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.swaps = 0
+
+    def current(self):
+        return self._snapshot
+
+    def refresh(self) -> bool:
+        """Returns True if a new snapshot was swapped in."""
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+                identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+                if self._snapshot is not None and self._snapshot.identity == identity:
+                    return False
+                self._snapshot = Snapshot(self.path)
+            except (OSError, ValueError, struct.error):
+                log.warning("Could not load snapshot %s; keeping the current one", self.path, exc_info=True)
+                return False
+            self.swaps += 1
+            log.info("Loaded recommendations snapshot %s for %s", self.path, self._snapshot.date)
+            return True
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "path": self.path,
+            "date": str(snapshot.date) if snapshot else None,
+            "entries": snapshot.n_entries if snapshot else 0,
+            "rows": snapshot.n_rows if snapshot else 0,
+            "swaps": self.swaps,
+        }
+
+
+class SnapshotFetcher:
+    """Downloads the snapshot the pipeline uploads to S3 into `path`.
+
+    The object is downloaded to a temp file next to `path`, validated and
+    then renamed over `path` with os.replace, which is what SnapshotStore
+    expects. Every worker on a host runs a fetcher, but they share the file:
+    the ETag of the object in place is stored next to it (`path`.etag) and
+    downloads are serialized with a lock file, so each new snapshot is
+    downloaded, and its inode replaced, once per host.
+    """
+
+    def __init__(self, uri: str, path: str):
+        if not uri.startswith("s3://"):
+            raise ValueError(f"Snapshot source must be an s3:// URI, got {uri!r}")
+        self.bucket, _, self.key = uri[len("s3://"):].partition("/")
+        self.path = path
+        self._client = None
+        self.downloads = 0
+        self.failures = 0
+
+    def _s3(self):
+        if self._client is None:
+            import boto3
+
+            self._client = boto3.client("s3", endpoint_url=os.environ.get("SNAPSHOT_S3_ENDPOINT_URL") or None)
+        return self._client
+
+    def fetch(self) -> bool:
+        """Returns True if a new snapshot was put in place."""
+        try:
+            return self._fetch()
+        except Exception:
+            self.failures += 1
+            raise
+
+    def _local_etag(self):
+        try:
+            with open(f"{self.path}.etag") as f:
+                etag = f.read()
+        except FileNotFoundError:
+            return None
+        return etag if os.path.exists(self.path) else None
+
+    def _fetch(self) -> bool:
+        s3 = self._s3()
+        etag = s3.head_object(Bucket=self.bucket, Key=self.key)["ETag"]
+        if etag == self._local_etag():
+            return False
+        with open(f"{self.path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another worker may have fetched it while we waited for the lock
+            if etag == self._local_etag():
+                return False
+            directory = os.path.dirname(self.path) or "."
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            os.close(fd)
+            try:
+                s3.download_file(self.bucket, self.key, tmp_path)
+                Snapshot(tmp_path)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(etag)
+            os.replace(tmp_path, f"{self.path}.etag")
+        self.downloads += 1
+        log.info("Fetched recommendations snapshot s3://%s/%s", self.bucket, self.key)
+        return True
+
+    def stats(self):
+        return {"source": f"s3://{self.bucket}/{self.key}", "downloads": self.downloads, "failures": self.failures}
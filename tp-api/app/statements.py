@@ -0,0 +1,162 @@
+import re
+from typing import NamedTuple
+
+_PARAM = re.compile(r"%\((\w+)\)s")
+
+
+class Statement(NamedTuple):
+    """A named hot query. `sql` uses %(name)s placeholders.
+
+    Passing a Statement instead of a SQL string to the data layer's
+    fetch_one/fetch_all runs it as a server-side prepared statement.
+    """
+    name: str
+    sql: str
+
+
+STATEMENTS = {}
+
+def register(name: str, sql: str) -> Statement:
+    stmt = Statement(name, sql)
+    STATEMENTS[name] = stmt
+    return stmt
+
+def to_positional(sql: str):
+    """Rewrite %(name)s placeholders as $1..$n for PREPARE.
+
+    Returns the rewritten SQL and the parameter names in $n order; a name
+    used more than once maps to the same $n.
+    """
+    names = []
+
+    def repl(m):
+        name = m.group(1)
+        if name not in names:
+            names.append(name)
+        return f"${names.index(name) + 1}"
+
+    return _PARAM.sub(repl, sql), names
+
+
+LATEST_RECOMMENDATIONS = register(
+    "latest_recommendations",
+    """
+    SELECT date, advertiser_id, model, product_id, rank, views, impressions, clicks, ctr
+    FROM recommendations
+    WHERE advertiser_id = %(adv)s AND model = %(model)s
+      AND date = (
+        SELECT MAX(date)
+        FROM recommendations
+        WHERE advertiser_id = %(adv)s AND model = %(model)s
+      )
+    ORDER BY rank ASC
+    """,
+)
+
+LATEST_RECOMMENDATIONS_BATCH = register(
+    "latest_recommendations_batch",
+    """
+    WITH latest AS (
+      SELECT r.advertiser_id, r.model, MAX(r.date) AS date
+      FROM recommendations r
+      JOIN unnest(%(advs)s::text[], %(models)s::text[]) AS p(advertiser_id, model)
+        USING (advertiser_id, model)
+      GROUP BY r.advertiser_id, r.model
+    )
+    SELECT r.date, r.advertiser_id, r.model, r.product_id, r.rank, r.views, r.impressions, r.clicks, r.ctr
+    FROM recommendations r
+    JOIN latest l USING (advertiser_id, model, date)
+    ORDER BY r.advertiser_id, r.model, r.rank ASC
+    """,
+)
+
+LATEST_PAYLOAD = register(
+    "latest_payload",
+    """
+    SELECT payload
+    FROM recommendations_payload
+    WHERE advertiser_id = %(adv)s AND model = %(model)s
+    ORDER BY date DESC
+    LIMIT 1
+    """,
+)
+
+LATEST_PAYLOAD_BATCH = register(
+    "latest_payload_batch",
+    """
+    SELECT DISTINCT ON (r.advertiser_id, r.model) r.advertiser_id, r.model, r.payload
+    FROM recommendations_payload r
+    JOIN unnest(%(advs)s::text[], %(models)s::text[]) AS p(advertiser_id, model)
+      USING (advertiser_id, model)
+    ORDER BY r.advertiser_id, r.model, r.date DESC
+    """,
+)
+
+# The 7-day window is anchored on the UTC date, like the history ETag in main.py
+# (CURRENT_DATE would follow the session's time zone).
+HISTORY = register(
+    "history",
+    """
+    SELECT date, model, product_id, rank, views, impressions, clicks, ctr
+    FROM recommendations
+    WHERE advertiser_id = %(adv)s
+      AND date >= (now() AT TIME ZONE 'UTC')::date - INTERVAL '7 days'
+    ORDER BY date DESC, model ASC, rank ASC
+    """,
+)
+
+# Same data as HISTORY, nested by date and model in Postgres; `document`
+# is the finished response body as text.
+HISTORY_DOCUMENT = register(
+    "history_document",
+    """
+    WITH per_model AS (
+      SELECT date, model,
+        json_agg(json_build_object(
+          'rank', rank, 'product_id', product_id, 'views', views,
+          'impressions', impressions, 'clicks', clicks, 'ctr', ctr
+        ) ORDER BY rank ASC) AS recs
+      FROM recommendations
+      WHERE advertiser_id = %(adv)s
+        AND date >= (now() AT TIME ZONE 'UTC')::date - INTERVAL '7 days'
+      GROUP BY date, model
+    ), per_date AS (
+      SELECT date, json_object_agg(model, recs ORDER BY model ASC) AS models
+      FROM per_model
+      GROUP BY date
+    )
+    SELECT
+      MAX(date) AS latest,
+      json_build_object(
+        'advertiser_id', %(adv)s::text,
+        'history', json_object_agg(date, models ORDER BY date DESC)
+      )::text AS document
+    FROM per_date
+    """,
+)
+
+STATS = register(
+    "stats",
+    """
+    SELECT
+      COUNT(DISTINCT advertiser_id) AS advertisers_total,
+      COUNT(*) AS rows_total,
+      MAX(date) AS max_date,
+      MIN(date) AS min_date
+    FROM recommendations
+    """,
+)
+
+# Maintained by the pipeline in the same transaction as each daily load.
+STATS_SUMMARY = register(
+    "stats_summary",
+    """
+    SELECT advertisers_total, rows_total, max_date, min_date
+    FROM recommendations_stats
+    """,
+)
+
+GENERATION = register(
+    "generation",
+    "SELECT MAX(generation) AS generation FROM recommendations_meta",
+)
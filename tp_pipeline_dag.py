@@ -1,5 +1,17 @@
-from datetime import datetime, timedelta
+import heapq
+import io
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 
+import numpy as np
 import pandas as pd
 from airflow import DAG
 from airflow.operators.python import PythonOperator
@@ -8,6 +20,12 @@ import psycopg2
 from psycopg2.extras import execute_values
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+
+import tp_schema
+
+log = logging.getLogger(__name__)
 
 # --------------------------------------
 # Configuración básica de rutas
@@ -19,12 +37,37 @@ ADVERTISERS_PATH = f"{RAW_DATA_DIR}/advertiser_ids.csv"
 PRODUCT_VIEWS_PATH = f"{RAW_DATA_DIR}/product_views.csv"
 ADS_VIEWS_PATH = f"{RAW_DATA_DIR}/ads_views.csv"
 
-PRODUCT_VIEWS_FILTERED_PATH = f"{PROCESSED_DATA_DIR}/product_views_filtered.csv"
-ADS_VIEWS_FILTERED_PATH = f"{PROCESSED_DATA_DIR}/ads_views_filtered.csv"
+# Formato de los resultados intermedios entre tasks: "parquet" (columnar,
+# tipado y comprimido) o "csv"
+INTERMEDIATE_FORMAT = os.environ.get("TP_INTERMEDIATE_FORMAT", "parquet")
+
+PRODUCT_VIEWS_FILTERED_PATH = f"{PROCESSED_DATA_DIR}/product_views_filtered.{INTERMEDIATE_FORMAT}"
+ADS_VIEWS_FILTERED_PATH = f"{PROCESSED_DATA_DIR}/ads_views_filtered.{INTERMEDIATE_FORMAT}"
+
+# Filtrado por bloques: la memoria pico depende de TP_FILTER_CHUNK_ROWS
+# y no del tamaño de los logs crudos
+FILTER_STREAMING = os.environ.get("TP_FILTER_STREAMING", "1") == "1"
+FILTER_CHUNK_ROWS = int(os.environ.get("TP_FILTER_CHUNK_ROWS", "1000000"))
+
+# Agregación por bloques: la memoria depende de la cantidad de pares
+# (advertiser, producto) distintos y no de la cantidad de eventos
+STREAMING_AGGREGATION = os.environ.get("TP_STREAMING_AGGREGATION", "1") == "1"
+AGGREGATION_CHUNK_ROWS = int(os.environ.get("TP_AGGREGATION_CHUNK_ROWS", str(FILTER_CHUNK_ROWS)))
 
-TOP_PRODUCT_PATH = f"{PROCESSED_DATA_DIR}/top_product.csv"
-TOP_CTR_PATH = f"{PROCESSED_DATA_DIR}/top_ctr.csv"
+# Si está activo, una sola task calcula TopProduct y TopCTR (en threads,
+# ahorrando el arranque de una task); si no, corren como dos tasks en paralelo
+FUSED_MODELS = os.environ.get("TP_FUSED_MODELS", "0") == "1"
+
+# Cantidad de productos recomendados por advertiser en cada modelo
+TOP_K = {
+    "top_product": int(os.environ.get("TP_TOP_PRODUCT_K", "20")),
+    "top_ctr": int(os.environ.get("TP_TOP_CTR_K", "20")),
+}
+
+TOP_PRODUCT_PATH = f"{PROCESSED_DATA_DIR}/top_product.{INTERMEDIATE_FORMAT}"
+TOP_CTR_PATH = f"{PROCESSED_DATA_DIR}/top_ctr.{INTERMEDIATE_FORMAT}"
 RECOMMENDATIONS_PATH = f"{PROCESSED_DATA_DIR}/recommendations.csv"
+SNAPSHOT_PATH = f"{PROCESSED_DATA_DIR}/recommendations.snapshot"
 
 # --------------------------------------
 # Configuración de la base de datos RDS
@@ -35,171 +78,962 @@ DB_NAME = "postgres"
 DB_USER = "grupo_6_2025"
 DB_PASSWORD = "NubeMLOPS!"
 
+# Carga en 'recommendations': "copy" (COPY FROM STDIN en CSV) o
+# "execute_values" (INSERT multi-fila)
+DB_LOAD_METHOD = os.environ.get("TP_DB_LOAD_METHOD", "copy")
+DB_COPY_CHUNK_ROWS = int(os.environ.get("TP_DB_COPY_CHUNK_ROWS", "50000"))
+
+# 'recommendations' particionada por día: cada día se carga en una tabla
+# de staging que se intercambia atómicamente por la partición del día.
+# Con TP_RETENTION_DAYS > 0 se eliminan las particiones más viejas.
+DB_PARTITIONED = os.environ.get("TP_DB_PARTITIONED", "0") == "1"
+RETENTION_DAYS = int(os.environ.get("TP_RETENTION_DAYS", "0"))
+
 # Bucket S3
 S3_BUCKET = "grupo-6-2025-s3"
+# Endpoint alternativo (p. ej. un S3 local como moto o MinIO para pruebas)
+S3_ENDPOINT_URL = os.environ.get("TP_S3_ENDPOINT_URL") or None
+
+# Transferencias multipart (y GETs por rangos) de S3_PART_SIZE bytes,
+# con hasta S3_MAX_CONCURRENCY partes en paralelo por archivo
+S3_PART_SIZE = int(os.environ.get("TP_S3_PART_MB", "8")) * 1024 * 1024
+S3_MAX_CONCURRENCY = int(os.environ.get("TP_S3_CONCURRENCY", "8"))
+# Lectura de los logs crudos directo desde S3, sin bajarlos a disco
+S3_STREAMING = os.environ.get("TP_S3_STREAMING", "0") == "1"
 
 
 # --------------------------------------
-# Funciones de cada tarea
+# Lectura y escritura de resultados intermedios
 # --------------------------------------
+# Columnas de ids que se guardan con dictionary encoding en Parquet
+ID_COLUMNS = ["advertiser_id", "product_id", "model", "type"]
 
-def filtrar_datos():
+# Los ids se leen siempre como texto (como en la tabla 'recommendations'):
+# inferirlos por bloque puede dar int64 en un bloque y texto en otro
+TIPOS_IDS = {"advertiser_id": str, "product_id": str}
+
+
+def escribir_intermedio(df, path):
     """
-    Descarga los CSV crudos desde S3 a disco local,
-    filtra por advertisers activos y guarda CSV filtrados
-    tanto localmente como en S3 (resultados intermedios).
+    Guarda un resultado intermedio en el formato configurado.
+    En Parquet los ids van con dictionary encoding y compresión zstd.
+    """
+    if INTERMEDIATE_FORMAT == "parquet":
+        df.to_parquet(
+            path,
+            index=False,
+            compression="zstd",
+            use_dictionary=[c for c in ID_COLUMNS if c in df.columns],
+        )
+    else:
+        df.to_csv(path, index=False)
+
+
+def leer_intermedio(path):
     """
-    s3 = boto3.client("s3")
+    Lee un resultado intermedio escrito por escribir_intermedio().
+    """
+    if INTERMEDIATE_FORMAT == "parquet":
+        return pd.read_parquet(path)
+    return pd.read_csv(path, dtype=TIPOS_IDS)
 
-    # 1) Descargar archivos de entrada desde S3 a las rutas locales
-    s3.download_file(S3_BUCKET, "advertiser_ids.csv", ADVERTISERS_PATH)
-    s3.download_file(S3_BUCKET, "product_views.csv", PRODUCT_VIEWS_PATH)
-    s3.download_file(S3_BUCKET, "ads_views.csv", ADS_VIEWS_PATH)
 
-    # 2) Leer y filtrar
-    advertisers = pd.read_csv(ADVERTISERS_PATH)
-    product_views = pd.read_csv(PRODUCT_VIEWS_PATH)
-    ads_views = pd.read_csv(ADS_VIEWS_PATH)
+class EscritorIntermedio:
+    """
+    Escribe un resultado intermedio bloque por bloque, sin mantenerlo
+    completo en memoria. Usa el mismo formato que escribir_intermedio().
+    """
 
-    active_ids = advertisers["advertiser_id"].unique()
+    def __init__(self, path):
+        self.path = path
+        self.filas = 0
+        self._parquet_writer = None
+        self._primer_bloque = True
 
-    product_views_filtered = product_views[
-        product_views["advertiser_id"].isin(active_ids)
-    ].copy()
+    def escribir(self, df):
+        if INTERMEDIATE_FORMAT == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
 
-    ads_views_filtered = ads_views[
-        ads_views["advertiser_id"].isin(active_ids)
-    ].copy()
+            tabla = pa.Table.from_pandas(df, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(
+                    self.path,
+                    tabla.schema,
+                    compression="zstd",
+                    use_dictionary=[c for c in ID_COLUMNS if c in df.columns],
+                )
+            else:
+                # Los tipos inferidos pueden variar entre bloques
+                tabla = tabla.cast(self._parquet_writer.schema)
+            self._parquet_writer.write_table(tabla)
+        else:
+            df.to_csv(
+                self.path,
+                mode="w" if self._primer_bloque else "a",
+                header=self._primer_bloque,
+                index=False,
+            )
+        self._primer_bloque = False
+        self.filas += len(df)
 
-    # Guardar local
-    product_views_filtered.to_csv(PRODUCT_VIEWS_FILTERED_PATH, index=False)
-    ads_views_filtered.to_csv(ADS_VIEWS_FILTERED_PATH, index=False)
-
-    # 3) Subir resultados filtrados a S3 como salidas intermedias
-    s3.upload_file(
-        PRODUCT_VIEWS_FILTERED_PATH,
-        S3_BUCKET,
-        "processed/product_views_filtered.csv",
+    def cerrar(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+
+
+def filtrar_por_bloques(origen, destino, active_ids):
+    """
+    Lee el log crudo 'origen' (ruta o archivo) en bloques de
+    FILTER_CHUNK_ROWS filas, se queda con los advertisers activos
+    y va escribiendo el resultado en 'destino'.
+    """
+    with EscritorIntermedio(destino) as escritor:
+        for bloque in pd.read_csv(origen, chunksize=FILTER_CHUNK_ROWS, dtype=TIPOS_IDS):
+            escritor.escribir(bloque[bloque["advertiser_id"].isin(active_ids)])
+    return escritor.filas
+
+
+def leer_intermedio_por_bloques(path, columns, chunk_rows):
+    """
+    Itera un resultado intermedio en DataFrames de a lo sumo
+    'chunk_rows' filas, leyendo solo las columnas pedidas.
+    """
+    if INTERMEDIATE_FORMAT == "parquet":
+        import pyarrow.parquet as pq
+
+        archivo = pq.ParquetFile(path)
+        for batch in archivo.iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_rows, dtype=TIPOS_IDS)
+
+
+# --------------------------------------
+# Transferencias S3
+# --------------------------------------
+_s3_client = None
+_s3_lock = threading.Lock()
+
+
+def cliente_s3():
+    """
+    Cliente S3 compartido por todas las transferencias del proceso
+    (los clientes de boto3 son thread-safe).
+    """
+    global _s3_client
+    with _s3_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client(
+                "s3",
+                endpoint_url=S3_ENDPOINT_URL,
+                # Conexiones suficientes para varias transferencias multipart a la vez
+                config=BotoConfig(max_pool_connections=max(10, S3_MAX_CONCURRENCY * 4)),
+            )
+        return _s3_client
+
+
+def _transfer_config():
+    return TransferConfig(
+        multipart_threshold=S3_PART_SIZE,
+        multipart_chunksize=S3_PART_SIZE,
+        max_concurrency=S3_MAX_CONCURRENCY,
     )
-    s3.upload_file(
-        ADS_VIEWS_FILTERED_PATH,
-        S3_BUCKET,
-        "processed/ads_views_filtered.csv",
+
+
+def _registrar_transferencia(operacion, key, path, inicio):
+    segundos = time.monotonic() - inicio
+    size = os.path.getsize(path)
+    metrica = {
+        "operacion": operacion,
+        "key": key,
+        "bytes": size,
+        "segundos": round(segundos, 3),
+        "mb_por_segundo": round(size / 1024 / 1024 / segundos, 2) if segundos > 0 else None,
+    }
+    log.info("S3 %(operacion)s s3://%(bucket)s/%(key)s: %(bytes)d bytes en %(segundos).3fs",
+             dict(metrica, bucket=S3_BUCKET))
+    return metrica
+
+
+def bajar_de_s3(key, path):
+    inicio = time.monotonic()
+    cliente_s3().download_file(S3_BUCKET, key, path, Config=_transfer_config())
+    return _registrar_transferencia("download", key, path, inicio)
+
+
+def subir_a_s3(path, key):
+    inicio = time.monotonic()
+    cliente_s3().upload_file(path, S3_BUCKET, key, Config=_transfer_config())
+    return _registrar_transferencia("upload", key, path, inicio)
+
+
+def transferir_en_paralelo(transferencias):
+    """
+    Ejecuta varias transferencias (funciones sin argumentos, p. ej.
+    bajar_de_s3/subir_a_s3 con functools.partial o lambda) a la vez y
+    devuelve sus métricas. Si alguna falla, se propaga el error.
+    """
+    if not transferencias:
+        return []
+    with ThreadPoolExecutor(max_workers=len(transferencias)) as pool:
+        futuros = [pool.submit(t) for t in transferencias]
+        metricas = [f.result() for f in futuros]
+    log.info(
+        "S3: %d transferencias, %d bytes en total",
+        len(metricas),
+        sum(m["bytes"] for m in metricas),
     )
+    return metricas
 
 
-def calcular_top_product():
+class LectorS3PorRangos(io.RawIOBase):
     """
-    Calcula TopProduct a partir del log filtrado de vistas de producto.
-    Guarda el resultado en top_product.csv (local) y también en S3.
+    Archivo de solo lectura sobre un objeto de S3. Baja el objeto con GETs
+    por rangos en paralelo y entrega los bytes en orden, con a lo sumo
+    'max_concurrency' partes en memoria a la vez.
+    """
+
+    def __init__(self, s3, bucket, key, part_size, max_concurrency):
+        super().__init__()
+        self._s3 = s3
+        self._bucket = bucket
+        self._key = key
+        size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self._rangos = iter(
+            (inicio, min(inicio + part_size, size) - 1)
+            for inicio in range(0, size, part_size)
+        )
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._pendientes = deque()
+        self._buffer = memoryview(b"")
+        for _ in range(max_concurrency):
+            self._programar()
+
+    def _programar(self):
+        rango = next(self._rangos, None)
+        if rango is not None:
+            self._pendientes.append(self._executor.submit(self._bajar, *rango))
+
+    def _bajar(self, inicio, fin):
+        respuesta = self._s3.get_object(
+            Bucket=self._bucket,
+            Key=self._key,
+            Range=f"bytes={inicio}-{fin}",
+        )
+        return respuesta["Body"].read()
+
+    def readable(self):
+        return True
+
+    def readinto(self, destino):
+        while not self._buffer:
+            if not self._pendientes:
+                return 0
+            self._buffer = memoryview(self._pendientes.popleft().result())
+            self._programar()
+        n = min(len(destino), len(self._buffer))
+        destino[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        super().close()
+
+
+def clave_s3_intermedia(path):
+    return f"processed/{os.path.basename(path)}"
+
+
+# --------------------------------------
+# Carga en la base de datos
+# --------------------------------------
+def conectar_db():
+    return psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+    )
+
+
+RECOMMENDATIONS_COLUMNS = [
+    "date",
+    "advertiser_id",
+    "model",
+    "product_id",
+    "rank",
+    "views",
+    "impressions",
+    "clicks",
+    "ctr",
+]
+
+
+class FuenteCopyCSV:
+    """
+    Objeto tipo archivo para cursor.copy_expert(): renderiza el DataFrame
+    a CSV de a 'filas_por_bloque' filas a medida que COPY lo va leyendo,
+    sin armar una tupla de Python por fila ni el CSV completo en memoria.
+    """
+
+    def __init__(self, df, filas_por_bloque):
+        # Enteros nullables para que pandas no los escriba como "12.0"
+        self._df = df.astype({c: "Int64" for c in ["rank", "views", "impressions", "clicks"]})
+        self._filas_por_bloque = filas_por_bloque
+        self._pos = 0
+        self._actual = io.StringIO()
+
+    def read(self, size=-1):
+        dato = self._actual.read(size)
+        while not dato and self._pos < len(self._df):
+            bloque = self._df.iloc[self._pos:self._pos + self._filas_por_bloque]
+            self._pos += self._filas_por_bloque
+            # Los NULL de COPY en CSV son campos vacíos sin comillas
+            self._actual = io.StringIO(bloque.to_csv(header=False, index=False))
+            dato = self._actual.read(size)
+        return dato
+
+
+def cargar_recomendaciones(cur, recommendations, tabla="recommendations"):
+    """
+    Inserta las recomendaciones en 'tabla' con COPY (por defecto) o, como
+    alternativa, con execute_values según TP_DB_LOAD_METHOD.
     """
-    product_views_filtered = pd.read_csv(PRODUCT_VIEWS_FILTERED_PATH)
+    columnas = ", ".join(RECOMMENDATIONS_COLUMNS)
+    if DB_LOAD_METHOD == "copy":
+        cur.copy_expert(
+            f"COPY {tabla} ({columnas}) FROM STDIN WITH (FORMAT csv)",
+            FuenteCopyCSV(recommendations[RECOMMENDATIONS_COLUMNS], DB_COPY_CHUNK_ROWS),
+        )
+        return
 
-    views = (
-        product_views_filtered
-        .groupby(["advertiser_id", "product_id"])
-        .size()
-        .reset_index(name="views")
+    # Convertir a lista de tuplas para psycopg2
+    records = [tuple(row) for row in recommendations[RECOMMENDATIONS_COLUMNS].to_numpy()]
+    execute_values(
+        cur,
+        f"INSERT INTO {tabla} ({columnas}) VALUES %s",
+        records,
     )
 
-    views = views.sort_values(
-        by=["advertiser_id", "views"],
-        ascending=[True, False]
+
+def nombre_particion(dia):
+    return f"recommendations_{dia:%Y%m%d}"
+
+
+def _verificar_particionada(cur):
+    cur.execute(
+        """
+        SELECT 1
+        FROM pg_partitioned_table
+        WHERE partrelid = to_regclass('recommendations')
+        """
     )
+    if cur.fetchone() is None:
+        raise ValueError(
+            "TP_DB_PARTITIONED=1 requiere que 'recommendations' esté "
+            "particionada con PARTITION BY RANGE (date)"
+        )
+
 
-    top_product = (
-        views
-        .groupby("advertiser_id")
-        .head(20)
-        .copy()
+def preparar_particion(cur, execution_date, recommendations):
+    """
+    Carga el día en una tabla de staging con la misma estructura que la
+    partición. Solo lee 'recommendations' (para copiar su estructura), así
+    que la API sigue leyendo sin bloquearse mientras dura la carga.
+    """
+    _verificar_particionada(cur)
+
+    dia = date.fromisoformat(execution_date)
+    siguiente = dia + timedelta(days=1)
+    particion = nombre_particion(dia)
+    staging = f"{particion}_staging"
+
+    # Staging con la misma estructura (e índices) que la tabla padre
+    cur.execute(f"DROP TABLE IF EXISTS {staging}")
+    cur.execute(f"CREATE TABLE {staging} (LIKE recommendations INCLUDING ALL)")
+    # Con este CHECK el ATTACH no necesita recorrer la tabla para validar
+    cur.execute(
+        f"ALTER TABLE {staging} ADD CONSTRAINT {particion}_rango "
+        "CHECK (date IS NOT NULL AND date >= %s AND date < %s)",
+        (dia, siguiente),
     )
+    cargar_recomendaciones(cur, recommendations, tabla=staging)
 
-    top_product["model"] = "top_product"
-    top_product["rank"] = (
-        top_product
-        .groupby("advertiser_id")
-        .cumcount() + 1
+
+def intercambiar_particion(cur, execution_date):
+    """
+    Intercambia la staging de preparar_particion() por la partición del día
+    (DETACH + DROP de la anterior, ATTACH de la nueva). Todo ocurre en la
+    transacción del llamador, así que los lectores ven el día completo
+    anterior o el nuevo, nunca uno a medio escribir, y no quedan filas
+    muertas para el vacuum.
+
+    DETACH toma un lock ACCESS EXCLUSIVE sobre 'recommendations' que dura
+    hasta el commit y frena todas las lecturas de la API: tiene que ser lo
+    último de la transacción, con todo lo demás ya hecho.
+    """
+    dia = date.fromisoformat(execution_date)
+    siguiente = dia + timedelta(days=1)
+    particion = nombre_particion(dia)
+    staging = f"{particion}_staging"
+
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (particion,))
+    if cur.fetchone()[0]:
+        cur.execute(f"ALTER TABLE recommendations DETACH PARTITION {particion}")
+        cur.execute(f"DROP TABLE {particion}")
+    cur.execute(f"ALTER TABLE {staging} RENAME TO {particion}")
+    cur.execute(
+        f"ALTER TABLE recommendations ATTACH PARTITION {particion} "
+        "FOR VALUES FROM (%s) TO (%s)",
+        (dia, siguiente),
     )
 
-    # Guardar local
-    top_product.to_csv(TOP_PRODUCT_PATH, index=False)
 
-    # Subir a S3 como resultado intermedio
-    s3 = boto3.client("s3")
-    s3.upload_file(
-        TOP_PRODUCT_PATH,
-        S3_BUCKET,
-        "processed/top_product.csv",
+def eliminar_particiones_viejas(cur, limite):
+    """
+    Elimina las particiones de días anteriores a 'limite' con
+    DETACH + DROP, sin DELETE fila por fila. Igual que
+    intercambiar_particion(), va al final de la transacción.
+    """
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'recommendations'::regclass
+        """
     )
+    for (particion,) in cur.fetchall():
+        if particion < nombre_particion(limite):
+            cur.execute(f"ALTER TABLE recommendations DETACH PARTITION {particion}")
+            cur.execute(f"DROP TABLE {particion}")
 
 
-def calcular_top_ctr():
+# --------------------------------------
+# Marcador de generación de datos
+# --------------------------------------
+
+def bump_generation(cur, execution_date):
     """
-    Calcula TopCTR a partir del log filtrado de vistas de ads.
-    Guarda el resultado en top_ctr.csv (local) y también en S3.
+    Incrementa el marcador de generación en 'recommendations_meta'.
+    La API compara este valor (barato de leer) contra el de sus entradas
+    en caché y las descarta cuando cambia. Debe llamarse dentro de la
+    misma transacción que escribe 'recommendations'.
+    """
+    # Serializa escritores concurrentes para que la generación sea monótona
+    cur.execute("LOCK TABLE recommendations_meta IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute(
+        """
+        INSERT INTO recommendations_meta (date, generation, updated_at)
+        SELECT %s, COALESCE(MAX(generation), 0) + 1, now()
+        FROM recommendations_meta
+        ON CONFLICT (date) DO UPDATE
+        SET generation = EXCLUDED.generation,
+            updated_at = EXCLUDED.updated_at
+        """,
+        (execution_date,),
+    )
+
+
+# --------------------------------------
+# Estadísticas materializadas para /stats
+# --------------------------------------
+
+def actualizar_estadisticas(cur, execution_date, recommendations, limite=None):
+    """
+    Reemplaza los conteos del día en 'recommendations_daily_stats', descarta
+    los anteriores a 'limite' (retención) y recalcula el resumen que sirve
+    /stats, tal como quedará la tabla al terminar la carga. Debe llamarse
+    dentro de la misma transacción que escribe 'recommendations'.
+
+    Los conteos salen del DataFrame. El total de advertisers distintos sí
+    recorre los demás días de 'recommendations' (un index-only scan sobre el
+    índice cubriente), pero solo con el lock de lectura: no bloquea a la API.
+    """
+    dia = date.fromisoformat(execution_date)
+    limite = limite or date.min
+    cur.execute(
+        """
+        INSERT INTO recommendations_daily_stats (date, rows_total, advertisers)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (date) DO UPDATE
+        SET rows_total = EXCLUDED.rows_total,
+            advertisers = EXCLUDED.advertisers
+        """,
+        (
+            execution_date,
+            len(recommendations),
+            int(recommendations["advertiser_id"].nunique()),
+        ),
+    )
+    cur.execute(
+        "DELETE FROM recommendations_daily_stats WHERE date < %s",
+        (limite,),
+    )
+    # Advertisers del resto de los días que sobreviven a la retención,
+    # más los del día que se está cargando
+    cur.execute(
+        """
+        SELECT COUNT(DISTINCT advertiser_id)
+        FROM (
+            SELECT advertiser_id FROM recommendations
+            WHERE date <> %s AND date >= %s
+            UNION ALL
+            SELECT unnest(%s::text[])
+        ) AS advertisers
+        """,
+        (dia, limite, [str(a) for a in recommendations["advertiser_id"].unique()]),
+    )
+    tp_schema.actualizar_resumen(cur, cur.fetchone()[0])
+
+
+# --------------------------------------
+# Respuestas pre-renderizadas para la API
+# --------------------------------------
+
+def renderizar_payloads(recommendations, execution_date):
+    """
+    Genera, para cada (advertiser, modelo), el JSON exacto que devuelve
+    /recommendations/{adv}/{model} en la API, para que esta lo sirva sin
+    armar la respuesta fila por fila.
     """
-    ads_views_filtered = pd.read_csv(ADS_VIEWS_FILTERED_PATH)
+    registros = []
+    ordenadas = recommendations.sort_values(["advertiser_id", "model", "rank"])
+    for (advertiser_id, model), grupo in ordenadas.groupby(["advertiser_id", "model"], sort=False):
+        recs = []
+        for r in grupo.itertuples(index=False):
+            item = {"rank": int(r.rank), "product_id": str(r.product_id)}
+            if model == "top_product":
+                item["views"] = int(r.views)
+            else:
+                item["impressions"] = int(r.impressions)
+                item["clicks"] = int(r.clicks)
+                item["ctr"] = float(r.ctr)
+            recs.append(item)
 
-    df = ads_views_filtered.copy()
-    df["impression"] = (df["type"] == "impression").astype(int)
-    df["click"] = (df["type"] == "click").astype(int)
+        payload = {
+            "advertiser_id": str(advertiser_id),
+            "model": model,
+            "date": execution_date,
+            "recommendations": recs,
+            "count": len(recs),
+        }
+        registros.append((
+            execution_date,
+            str(advertiser_id),
+            model,
+            json.dumps(payload, separators=(",", ":")),
+        ))
+    return registros
 
-    agg = (
-        df.groupby(["advertiser_id", "product_id"])
-        .agg(
-            impressions=("impression", "sum"),
-            clicks=("click", "sum"),
+
+def escribir_payloads(cur, execution_date, payloads, limite=None):
+    """
+    Reemplaza los payloads del día en 'recommendations_payload' por los
+    de renderizar_payloads() y descarta los anteriores a 'limite'
+    (retención). Debe llamarse dentro de la misma transacción que escribe
+    'recommendations'.
+    """
+    cur.execute(
+        "DELETE FROM recommendations_payload WHERE date = %s",
+        (execution_date,),
+    )
+    if limite is not None:
+        cur.execute(
+            "DELETE FROM recommendations_payload WHERE date < %s",
+            (limite,),
         )
-        .reset_index()
+    execute_values(
+        cur,
+        """
+        INSERT INTO recommendations_payload (date, advertiser_id, model, payload)
+        VALUES %s
+        """,
+        payloads,
     )
 
-    # Nos quedamos con productos que tengan al menos 1 impresión
-    agg = agg[agg["impressions"] > 0].copy()
 
-    agg["ctr"] = agg["clicks"] / agg["impressions"]
+# --------------------------------------
+# Snapshot binario para la API (modo mmap)
+# --------------------------------------
+# Formato (little-endian), leído por tp-api/app/snapshot.py; mantener ambos
+# lados sincronizados (lo verifica tests/test_snapshot_roundtrip.py):
+#   header:  magic, versión, flags, fecha (ordinal), n_entradas, n_filas,
+#            offset índice, offset filas, offset strings, tamaño total del
+#            archivo y CRC32 de todo lo que sigue al header
+#   índice:  una entrada por (advertiser, modelo), ordenadas por
+#            (advertiser en UTF-8, código de modelo) para búsqueda binaria
+#   filas:   registros de ancho fijo con rank, producto y métricas
+#   strings: ids de advertiser y producto en UTF-8
+SNAPSHOT_MAGIC = b"TPRS"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_MODELS = {"top_product": 0, "top_ctr": 1}
+_SNAPSHOT_HEADER = struct.Struct("<4sHHiIIQQQQI")
+_SNAPSHOT_ENTRY = struct.Struct("<IIB3xII")
+_SNAPSHOT_ROW = struct.Struct("<IIIqqqd")
+
+
+def _entero(valor):
+    return 0 if pd.isna(valor) else int(valor)
+
+
+def escribir_snapshot(recommendations, execution_date, path):
+    """
+    Escribe las recomendaciones del día en el formato binario de snapshot.
+    Se escribe a un archivo temporal y se renombra, para que la API nunca
+    vea un archivo a medio escribir.
+    """
+    ordenadas = recommendations.assign(
+        adv_key=recommendations["advertiser_id"].astype(str),
+        model_code=recommendations["model"].map(SNAPSHOT_MODELS),
+    ).sort_values(["adv_key", "model_code", "rank"])
 
-    agg = agg.sort_values(
-        by=["advertiser_id", "ctr"],
-        ascending=[True, False]
+    strings = bytearray()
+    string_offsets = {}
+
+    def guardar_string(texto):
+        data = texto.encode("utf-8")
+        if data not in string_offsets:
+            string_offsets[data] = len(strings)
+            strings.extend(data)
+        return string_offsets[data], len(data)
+
+    entries = bytearray()
+    rows = bytearray()
+    n_entries = 0
+    n_rows = 0
+    for (adv_key, model_code), grupo in ordenadas.groupby(["adv_key", "model_code"], sort=False):
+        adv_offset, adv_len = guardar_string(adv_key)
+        entries.extend(_SNAPSHOT_ENTRY.pack(adv_offset, adv_len, int(model_code), n_rows, len(grupo)))
+        n_entries += 1
+        for r in grupo.itertuples(index=False):
+            prod_offset, prod_len = guardar_string(str(r.product_id))
+            rows.extend(_SNAPSHOT_ROW.pack(
+                prod_offset,
+                prod_len,
+                int(r.rank),
+                _entero(r.views),
+                _entero(r.impressions),
+                _entero(r.clicks),
+                0.0 if pd.isna(r.ctr) else float(r.ctr),
+            ))
+            n_rows += 1
+
+    index_offset = _SNAPSHOT_HEADER.size
+    rows_offset = index_offset + len(entries)
+    strings_offset = rows_offset + len(rows)
+    crc = zlib.crc32(strings, zlib.crc32(rows, zlib.crc32(entries)))
+    header = _SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC,
+        SNAPSHOT_VERSION,
+        0,  # flags, reservado
+        date.fromisoformat(execution_date).toordinal(),
+        n_entries,
+        n_rows,
+        index_offset,
+        rows_offset,
+        strings_offset,
+        strings_offset + len(strings),
+        crc,
     )
 
-    top_ctr = (
-        agg
-        .groupby("advertiser_id")
-        .head(20)
-        .copy()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(entries)
+        f.write(rows)
+        f.write(strings)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# --------------------------------------
+# Cálculo de los modelos
+# --------------------------------------
+CLAVES_MODELO = ["advertiser_id", "product_id"]
+
+
+def contar_views(product_views):
+    """
+    Vistas por (advertiser_id, product_id), indexado por esas claves.
+    """
+    return product_views.groupby(CLAVES_MODELO).size().to_frame("views")
+
+
+def contar_ads(ads_views):
+    """
+    Impresiones y clicks por (advertiser_id, product_id), indexado por esas claves.
+    """
+    df = ads_views[CLAVES_MODELO].copy()
+    df["impressions"] = (ads_views["type"] == "impression").astype("int64")
+    df["clicks"] = (ads_views["type"] == "click").astype("int64")
+    return df.groupby(CLAVES_MODELO)[["impressions", "clicks"]].sum()
+
+
+class AgregadorIncremental:
+    """
+    Acumula conteos por (advertiser_id, product_id) a medida que consume
+    bloques de un log. Cada bloque se reduce con 'contar' y los parciales
+    se juntan en un buffer; cuando el buffer supera 'filas_buffer' filas y
+    el tamaño de los totales, se reduce todo con un solo groupby. Así el
+    costo total es aproximadamente lineal y la memoria crece con los pares
+    distintos y no con la cantidad de eventos.
+    """
+
+    def __init__(self, contar, columns, filas_buffer=1_000_000):
+        self._contar = contar
+        self._columns = columns
+        self._filas_buffer = filas_buffer
+        self._totales = None
+        self._parciales = []
+        self._filas_parciales = 0
+
+    def consumir(self, bloque):
+        parcial = self._contar(bloque)
+        self._parciales.append(parcial)
+        self._filas_parciales += len(parcial)
+        limite = max(self._filas_buffer, 0 if self._totales is None else len(self._totales))
+        if self._filas_parciales > limite:
+            self._reducir()
+
+    def _reducir(self):
+        partes = self._parciales if self._totales is None else [self._totales] + self._parciales
+        self._totales = pd.concat(partes).groupby(level=[0, 1]).sum()
+        self._parciales = []
+        self._filas_parciales = 0
+
+    def totales(self):
+        if self._parciales:
+            self._reducir()
+        if self._totales is None:
+            # Log vacío: mismas columnas que con datos, sin filas
+            return self._contar(pd.DataFrame(columns=self._columns)).reset_index()
+        return self._totales.astype("int64").reset_index()
+
+
+def agregar_por_bloques(path, columns, contar):
+    agregador = AgregadorIncremental(contar, columns, filas_buffer=AGGREGATION_CHUNK_ROWS)
+    for bloque in leer_intermedio_por_bloques(path, columns, AGGREGATION_CHUNK_ROWS):
+        agregador.consumir(bloque)
+    return agregador.totales()
+
+
+def _posiciones_menores(valores, n):
+    """
+    Posiciones de los n valores más chicos de 'valores', sin ordenar todo.
+    """
+    if len(valores) <= n:
+        return np.arange(len(valores))
+    if np.issubdtype(valores.dtype, np.number):
+        return np.argpartition(valores, n - 1)[:n]
+    return np.array(heapq.nsmallest(n, range(len(valores)), key=valores.__getitem__))
+
+
+def seleccionar_top_k(df, score, k):
+    """
+    Devuelve los k productos con mayor 'score' de cada advertiser, con su
+    'rank'. En vez de ordenar todas las filas, para cada advertiser con más
+    de k productos se busca el k-ésimo score con una selección parcial (np.partition) y solo
+    se ordenan los candidatos. Los empates se resuelven por product_id
+    ascendente, así el resultado es determinista.
+    """
+    if df.empty or k <= 0:
+        return df.iloc[0:0].assign(rank=pd.Series(dtype="int64"))
+
+    # Los advertisers con k productos o menos entran completos; solo se
+    # recorren en Python los que tienen más de k (la cola larga no cuesta)
+    codigos, _ = pd.factorize(df["advertiser_id"])
+    tamanos = np.bincount(codigos[codigos >= 0], minlength=1)
+    tamano_fila = np.where(codigos >= 0, tamanos[np.maximum(codigos, 0)], 0)
+    seleccion = [np.flatnonzero((codigos >= 0) & (tamano_fila <= k))]
+
+    grandes = np.flatnonzero(tamano_fila > k)
+    if len(grandes):
+        scores = df[score].to_numpy()
+        productos = df["product_id"].to_numpy()
+        por_advertiser = df.iloc[grandes].groupby("advertiser_id", sort=False).indices
+        for idx in por_advertiser.values():
+            idx = grandes[idx]
+            valores = scores[idx]
+            corte = len(valores) - k
+            umbral = np.partition(valores, corte)[corte]
+            mayores = idx[valores > umbral]
+            empatados = idx[valores == umbral]
+            empatados = empatados[_posiciones_menores(productos[empatados], k - len(mayores))]
+            seleccion.append(np.concatenate([mayores, empatados]))
+
+    top = df.iloc[np.concatenate(seleccion)].sort_values(
+        by=["advertiser_id", score, "product_id"],
+        ascending=[True, False, True],
+        kind="mergesort",
     )
+    top["rank"] = top.groupby("advertiser_id").cumcount() + 1
+    return top
+
+
+def rankear_top_product(views):
+    """
+    Top K productos por vistas para cada advertiser.
+    """
+    top_product = seleccionar_top_k(views, "views", TOP_K["top_product"])
+    top_product["model"] = "top_product"
+    return top_product
+
+
+def rankear_top_ctr(agg):
+    """
+    Top K productos por CTR para cada advertiser.
+    """
+    # Nos quedamos con productos que tengan al menos 1 impresión
+    agg = agg[agg["impressions"] > 0].copy()
 
+    agg["ctr"] = agg["clicks"] / agg["impressions"]
+
+    top_ctr = seleccionar_top_k(agg, "ctr", TOP_K["top_ctr"])
     top_ctr["model"] = "top_ctr"
-    top_ctr["rank"] = (
-        top_ctr
-        .groupby("advertiser_id")
-        .cumcount() + 1
-    )
+    return top_ctr
+
+
+# --------------------------------------
+# Funciones de cada tarea
+# --------------------------------------
+
+def filtrar_datos():
+    """
+    Descarga los CSV crudos desde S3 a disco local,
+    filtra por advertisers activos y guarda los logs filtrados
+    tanto localmente como en S3 (resultados intermedios).
+    """
+    # 1) Descargar archivos de entrada desde S3 a las rutas locales, en paralelo
+    descargas = [lambda: bajar_de_s3("advertiser_ids.csv", ADVERTISERS_PATH)]
+    if not S3_STREAMING:
+        descargas.append(lambda: bajar_de_s3("product_views.csv", PRODUCT_VIEWS_PATH))
+        descargas.append(lambda: bajar_de_s3("ads_views.csv", ADS_VIEWS_PATH))
+    transferir_en_paralelo(descargas)
+
+    # 2) Leer y filtrar
+    advertisers = pd.read_csv(ADVERTISERS_PATH, dtype=TIPOS_IDS)
 
+    if S3_STREAMING:
+        # Los logs crudos se leen directo de S3 y nunca se escriben a disco
+        active_ids = pd.Index(advertisers["advertiser_id"].unique())
+        for key, destino in (
+            ("product_views.csv", PRODUCT_VIEWS_FILTERED_PATH),
+            ("ads_views.csv", ADS_VIEWS_FILTERED_PATH),
+        ):
+            with LectorS3PorRangos(cliente_s3(), S3_BUCKET, key, S3_PART_SIZE, S3_MAX_CONCURRENCY) as origen:
+                filtrar_por_bloques(io.BufferedReader(origen, S3_PART_SIZE), destino, active_ids)
+    elif FILTER_STREAMING:
+        # Índice hash de ids activos, reutilizado en cada bloque
+        active_ids = pd.Index(advertisers["advertiser_id"].unique())
+        filtrar_por_bloques(PRODUCT_VIEWS_PATH, PRODUCT_VIEWS_FILTERED_PATH, active_ids)
+        filtrar_por_bloques(ADS_VIEWS_PATH, ADS_VIEWS_FILTERED_PATH, active_ids)
+    else:
+        product_views = pd.read_csv(PRODUCT_VIEWS_PATH, dtype=TIPOS_IDS)
+        ads_views = pd.read_csv(ADS_VIEWS_PATH, dtype=TIPOS_IDS)
+
+        active_ids = advertisers["advertiser_id"].unique()
+
+        product_views_filtered = product_views[
+            product_views["advertiser_id"].isin(active_ids)
+        ].copy()
+
+        ads_views_filtered = ads_views[
+            ads_views["advertiser_id"].isin(active_ids)
+        ].copy()
+
+        # Guardar local
+        escribir_intermedio(product_views_filtered, PRODUCT_VIEWS_FILTERED_PATH)
+        escribir_intermedio(ads_views_filtered, ADS_VIEWS_FILTERED_PATH)
+
+    # 3) Subir resultados filtrados a S3 como salidas intermedias, en paralelo
+    transferir_en_paralelo([
+        lambda: subir_a_s3(PRODUCT_VIEWS_FILTERED_PATH, clave_s3_intermedia(PRODUCT_VIEWS_FILTERED_PATH)),
+        lambda: subir_a_s3(ADS_VIEWS_FILTERED_PATH, clave_s3_intermedia(ADS_VIEWS_FILTERED_PATH)),
+    ])
+
+
+def contar_product_views_filtrado():
+    if STREAMING_AGGREGATION:
+        return agregar_por_bloques(PRODUCT_VIEWS_FILTERED_PATH, CLAVES_MODELO, contar_views)
+    product_views_filtered = leer_intermedio(PRODUCT_VIEWS_FILTERED_PATH)
+    return contar_views(product_views_filtered).reset_index()
+
+
+def contar_ads_views_filtrado():
+    if STREAMING_AGGREGATION:
+        return agregar_por_bloques(ADS_VIEWS_FILTERED_PATH, CLAVES_MODELO + ["type"], contar_ads)
+    ads_views_filtered = leer_intermedio(ADS_VIEWS_FILTERED_PATH)
+    return contar_ads(ads_views_filtered).reset_index()
+
+
+def guardar_top(top, path):
     # Guardar local
-    top_ctr.to_csv(TOP_CTR_PATH, index=False)
+    escribir_intermedio(top, path)
 
     # Subir a S3 como resultado intermedio
-    s3 = boto3.client("s3")
-    s3.upload_file(
-        TOP_CTR_PATH,
-        S3_BUCKET,
-        "processed/top_ctr.csv",
-    )
+    subir_a_s3(path, clave_s3_intermedia(path))
 
 
-def db_writing(**context):
+def calcular_top_product():
     """
-    Lee los CSV de top_product y top_ctr, los combina en un único
-    DataFrame y lo inserta en la tabla 'recommendations' de RDS.
+    Calcula TopProduct a partir del log filtrado de vistas de producto.
+    Guarda el resultado en top_product (local) y también en S3.
     """
-    # Fecha de ejecución del DAG (YYYY-MM-DD) que Airflow pasa en el contexto
-    execution_date = context["ds"]  # string, ej: "2025-12-03"
+    guardar_top(rankear_top_product(contar_product_views_filtrado()), TOP_PRODUCT_PATH)
+
+
+def calcular_top_ctr():
+    """
+    Calcula TopCTR a partir del log filtrado de vistas de ads.
+    Guarda el resultado en top_ctr (local) y también en S3.
+    """
+    guardar_top(rankear_top_ctr(contar_ads_views_filtrado()), TOP_CTR_PATH)
+
+
+def calcular_recomendaciones():
+    """
+    Calcula TopProduct y TopCTR en una sola task, con los dos conteos en
+    threads y las dos subidas a S3 en paralelo. Deja los mismos resultados
+    que calcular_top_product() y calcular_top_ctr().
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        views = pool.submit(contar_product_views_filtrado)
+        agg = pool.submit(contar_ads_views_filtrado)
+        top_product = rankear_top_product(views.result())
+        top_ctr = rankear_top_ctr(agg.result())
+
+    # Guardar local
+    escribir_intermedio(top_product, TOP_PRODUCT_PATH)
+    escribir_intermedio(top_ctr, TOP_CTR_PATH)
+
+    # Subir ambos a S3 a la vez
+    transferir_en_paralelo([
+        lambda: subir_a_s3(TOP_PRODUCT_PATH, clave_s3_intermedia(TOP_PRODUCT_PATH)),
+        lambda: subir_a_s3(TOP_CTR_PATH, clave_s3_intermedia(TOP_CTR_PATH)),
+    ])
 
-    # 1) Leer los CSV generados por las tasks anteriores (locales)
-    top_product = pd.read_csv(TOP_PRODUCT_PATH)
-    top_ctr = pd.read_csv(TOP_CTR_PATH)
+
+def combinar_recomendaciones(execution_date):
+    """
+    Lee los resultados de top_product y top_ctr y los combina en un único
+    DataFrame con las columnas de la tabla 'recommendations'.
+    """
+    # 1) Leer los resultados generados por las tasks anteriores (locales)
+    top_product = leer_intermedio(TOP_PRODUCT_PATH)
+    top_ctr = leer_intermedio(TOP_CTR_PATH)
 
     # Asegurar columnas para que sean compatibles
     # TopProduct no tiene columnas de ads
@@ -222,57 +1056,88 @@ def db_writing(**context):
     recommendations["date"] = execution_date
 
     # 4) Reordenar columnas para que coincidan con la tabla SQL
-    columns = [
-        "date",
-        "advertiser_id",
-        "model",
-        "product_id",
-        "rank",
-        "views",
-        "impressions",
-        "clicks",
-        "ctr",
-    ]
-    recommendations = recommendations[columns]
-
-    # 5) Convertir a lista de tuplas para psycopg2
-    records = [tuple(row) for row in recommendations.to_numpy()]
-
-    insert_sql = """
-        INSERT INTO recommendations (
-            date,
-            advertiser_id,
-            model,
-            product_id,
-            rank,
-            views,
-            impressions,
-            clicks,
-            ctr
-        ) VALUES %s
+    return recommendations[RECOMMENDATIONS_COLUMNS]
+
+
+def preparar_esquema():
     """
+    Aplica las migraciones pendientes (tablas e índices de tp_schema)
+    y verifica que el esquema quedó como espera la API.
+    """
+    with conectar_db() as conn:
+        aplicadas = tp_schema.aplicar_migraciones(conn, particionada=DB_PARTITIONED)
+        if aplicadas:
+            log.info("Migraciones aplicadas: %s", aplicadas)
+        with conn.cursor() as cur:
+            tp_schema.verificar_esquema(cur)
 
-    # 6) Conectar a la base en RDS y hacer el insert masivo
-    with psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-    ) as conn:
+
+def db_writing(**context):
+    """
+    Combina top_product y top_ctr en un único DataFrame
+    y lo inserta en la tabla 'recommendations' de RDS.
+    """
+    # Fecha de ejecución del DAG (YYYY-MM-DD) que Airflow pasa en el contexto
+    execution_date = context["ds"]  # string, ej: "2025-12-03"
+
+    recommendations = combinar_recomendaciones(execution_date)
+
+    # Lo que se calcula en Python va antes de abrir la transacción
+    payloads = renderizar_payloads(recommendations, execution_date)
+    limite = None
+    if DB_PARTITIONED and RETENTION_DAYS > 0:
+        limite = date.fromisoformat(execution_date) - timedelta(days=RETENTION_DAYS)
+
+    # 5) Conectar a la base en RDS y hacer la carga masiva
+    with conectar_db() as conn:
         with conn.cursor() as cur:
-            # Opcional: borrar datos previos de ese día para evitar duplicados
-            cur.execute(
-                "DELETE FROM recommendations WHERE date = %s",
-                (execution_date,),
-            )
+            if DB_PARTITIONED:
+                # Carga en staging; la partición del día se intercambia al final
+                preparar_particion(cur, execution_date, recommendations)
+            else:
+                # Opcional: borrar datos previos de ese día para evitar duplicados
+                cur.execute(
+                    "DELETE FROM recommendations WHERE date = %s",
+                    (execution_date,),
+                )
+
+                # Carga masiva
+                cargar_recomendaciones(cur, recommendations)
 
-            # Insert masivo
-            execute_values(cur, insert_sql, records)
+            # Respuestas pre-renderizadas por (advertiser, modelo)
+            escribir_payloads(cur, execution_date, payloads, limite)
+
+            # Resumen para /stats, sin que la API tenga que recorrer la tabla
+            actualizar_estadisticas(cur, execution_date, recommendations, limite)
+
+            if DB_PARTITIONED:
+                # Desde acá hasta el commit las lecturas de 'recommendations'
+                # quedan bloqueadas (ACCESS EXCLUSIVE): solo DDL y la generación
+                intercambiar_particion(cur, execution_date)
+                if limite is not None:
+                    eliminar_particiones_viejas(cur, limite)
+
+            # Marcar nueva generación en la misma transacción para que la API
+            # invalide su caché solo cuando realmente llegan datos nuevos
+            bump_generation(cur, execution_date)
 
         conn.commit()
 
 
+def generar_snapshot(**context):
+    """
+    Genera el snapshot binario del día para el modo mmap de la API
+    y lo sube a S3. Cada host de la API lo baja de ahí (SNAPSHOT_S3_URI,
+    ver tp-api/app/snapshot.py:SnapshotFetcher) y lo reemplaza atómicamente.
+    """
+    execution_date = context["ds"]
+
+    recommendations = combinar_recomendaciones(execution_date)
+    escribir_snapshot(recommendations, execution_date, SNAPSHOT_PATH)
+
+    subir_a_s3(SNAPSHOT_PATH, "snapshots/recommendations.snapshot")
+
+
 # --------------------------------------
 # Definición del DAG
 # --------------------------------------
@@ -299,14 +1164,30 @@ with DAG(
         python_callable=filtrar_datos,
     )
 
-    top_product_task = PythonOperator(
-        task_id="TopProduct",
-        python_callable=calcular_top_product,
-    )
+    if FUSED_MODELS:
+        model_tasks = [
+            PythonOperator(
+                task_id="Recomendaciones",
+                python_callable=calcular_recomendaciones,
+            )
+        ]
+    else:
+        top_product_task = PythonOperator(
+            task_id="TopProduct",
+            python_callable=calcular_top_product,
+        )
+
+        top_ctr_task = PythonOperator(
+            task_id="TopCTR",
+            python_callable=calcular_top_ctr,
+        )
+
+        # No dependen entre sí: corren en paralelo
+        model_tasks = [top_product_task, top_ctr_task]
 
-    top_ctr_task = PythonOperator(
-        task_id="TopCTR",
-        python_callable=calcular_top_ctr,
+    esquema_task = PythonOperator(
+        task_id="EsquemaDB",
+        python_callable=preparar_esquema,
     )
 
     db_writing_task = PythonOperator(
@@ -315,5 +1196,11 @@ with DAG(
         op_kwargs={},  # usamos context["ds"]
     )
 
+    snapshot_task = PythonOperator(
+        task_id="Snapshot",
+        python_callable=generar_snapshot,
+    )
+
     # Orden de ejecución
-    filtrar_datos_task >> top_product_task >> top_ctr_task >> db_writing_task
+    filtrar_datos_task >> model_tasks >> db_writing_task >> snapshot_task
+    esquema_task >> db_writing_task
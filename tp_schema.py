@@ -0,0 +1,204 @@
+"""
+Esquema de la base de recomendaciones y sus migraciones.
+
+Lo usa el DAG (tp_pipeline_dag.py) para crear y actualizar las tablas e
+índices antes de escribir. La API solo verifica el resultado al arrancar
+(tp-api/app/schema.py); si se agrega una migración, actualizar también
+EXPECTED_SCHEMA_VERSION y REQUIRED_INDEXES allí.
+"""
+
+# Índice cubriente para /recommendations (advertiser, model, último día,
+# rank) y /history (advertiser + rango de fechas): con las métricas en
+# INCLUDE, ambos endpoints pueden resolverse con index-only scans.
+LOOKUP_INDEX = "recommendations_lookup_idx"
+
+# Clave para pg_advisory_xact_lock: serializa migraciones concurrentes
+_MIGRATIONS_LOCK_KEY = 727_001
+
+
+def _m1_recommendations(cur, particionada):
+    particion = "PARTITION BY RANGE (date)" if particionada else ""
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS recommendations (
+            date DATE NOT NULL,
+            advertiser_id TEXT NOT NULL,
+            model TEXT NOT NULL,
+            product_id TEXT NOT NULL,
+            rank INTEGER NOT NULL,
+            views BIGINT,
+            impressions BIGINT,
+            clicks BIGINT,
+            ctr DOUBLE PRECISION
+        ) {particion}
+        """
+    )
+
+
+def _m2_recommendations_meta(cur, particionada):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recommendations_meta (
+            date DATE PRIMARY KEY,
+            generation BIGINT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """
+    )
+
+
+def _m3_recommendations_payload(cur, particionada):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recommendations_payload (
+            date DATE NOT NULL,
+            advertiser_id TEXT NOT NULL,
+            model TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (advertiser_id, model, date)
+        )
+        """
+    )
+
+
+def _m4_lookup_index(cur, particionada):
+    cur.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS {LOOKUP_INDEX}
+        ON recommendations (advertiser_id, model, date DESC, rank)
+        INCLUDE (product_id, views, impressions, clicks, ctr)
+        """
+    )
+
+
+def _m5_recommendations_stats(cur, particionada):
+    # Conteos por día (mantenidos por el DAG al cargar cada día) y un resumen
+    # de una sola fila que /stats lee sin recorrer 'recommendations'
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recommendations_daily_stats (
+            date DATE PRIMARY KEY,
+            rows_total BIGINT NOT NULL,
+            advertisers BIGINT NOT NULL
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recommendations_stats (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            advertisers_total BIGINT NOT NULL,
+            rows_total BIGINT NOT NULL,
+            min_date DATE,
+            max_date DATE,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """
+    )
+    # Backfill con los días ya cargados (única vez que se recorre toda la tabla)
+    cur.execute(
+        """
+        INSERT INTO recommendations_daily_stats (date, rows_total, advertisers)
+        SELECT date, COUNT(*), COUNT(DISTINCT advertiser_id)
+        FROM recommendations
+        GROUP BY date
+        ON CONFLICT (date) DO NOTHING
+        """
+    )
+    cur.execute("SELECT COUNT(DISTINCT advertiser_id) FROM recommendations")
+    actualizar_resumen(cur, cur.fetchone()[0])
+
+
+def actualizar_resumen(cur, advertisers_total):
+    """
+    Recalcula la fila de 'recommendations_stats' a partir de los conteos
+    por día y del total de advertisers distintos, que calcula el llamador.
+    """
+    cur.execute(
+        """
+        INSERT INTO recommendations_stats
+            (id, advertisers_total, rows_total, min_date, max_date, updated_at)
+        SELECT
+            TRUE,
+            %s,
+            COALESCE(SUM(rows_total), 0),
+            MIN(date),
+            MAX(date),
+            now()
+        FROM recommendations_daily_stats
+        ON CONFLICT (id) DO UPDATE
+        SET advertisers_total = EXCLUDED.advertisers_total,
+            rows_total = EXCLUDED.rows_total,
+            min_date = EXCLUDED.min_date,
+            max_date = EXCLUDED.max_date,
+            updated_at = EXCLUDED.updated_at
+        """,
+        (advertisers_total,),
+    )
+
+
+# (versión, descripción, función). Solo se agregan al final.
+MIGRACIONES = [
+    (1, "tabla recommendations", _m1_recommendations),
+    (2, "tabla recommendations_meta", _m2_recommendations_meta),
+    (3, "tabla recommendations_payload", _m3_recommendations_payload),
+    (4, "índice cubriente de recommendations", _m4_lookup_index),
+    (5, "estadísticas materializadas para /stats", _m5_recommendations_stats),
+]
+
+SCHEMA_VERSION = MIGRACIONES[-1][0]
+
+
+def version_actual(cur):
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return cur.fetchone()[0]
+
+
+def aplicar_migraciones(conn, particionada=False):
+    """
+    Aplica, en una transacción, las migraciones que falten. 'particionada'
+    solo afecta la creación inicial de 'recommendations'; una tabla que ya
+    existe no se modifica. Devuelve las versiones aplicadas.
+    """
+    aplicadas = []
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRATIONS_LOCK_KEY,))
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """
+        )
+        actual = version_actual(cur)
+        for version, descripcion, migrar in MIGRACIONES:
+            if version <= actual:
+                continue
+            migrar(cur, particionada)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, descripcion),
+            )
+            aplicadas.append(version)
+    conn.commit()
+    return aplicadas
+
+
+def verificar_esquema(cur):
+    """
+    Lanza RuntimeError si la base no tiene todas las migraciones
+    o falta el índice cubriente.
+    """
+    actual = version_actual(cur)
+    if actual < SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Esquema en versión {actual}, se esperaba {SCHEMA_VERSION}"
+        )
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (LOOKUP_INDEX,))
+    if not cur.fetchone()[0]:
+        raise RuntimeError(f"Falta el índice {LOOKUP_INDEX}")